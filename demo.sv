@@ -7,6 +7,15 @@ logic [31:0] buffer[8][16];
 wire [9-1:0] rid;
 wire [9-1:0] rid;
 
+//DEMO: macro values in expressions, a macro reads like its text: 9, 9-1, 0
+wire rid_bit_0;
+wire rid_bit_4;
+wire rid_bit_8;
+wire [9-1:0] rid_top;
+	assign feat_ena = 1;
+//DEMO: $var inside a string literal pastes its text
+wire rid_9_w;
+
 
 wire alu_vld = 0;
 
@@ -0,0 +1,215 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import concurrent.futures
+
+import expand_gen
+
+#USEAGE: python expand_bench.py -o bench.json [--baseline old.json --threshold 0.2] [--scale 2]
+
+
+def workload_nested_for(scale): #deeply nested for loops
+    depth, width = 4, 4 + 2 * scale
+    lines = []
+    for level in range(depth):
+        lines.append(f"//:for($i{level}=0;$i{level}<$n;$i{level}++) {{")
+    lines.append("assign w_" + "_".join(f"${{i{level}}}" for level in range(depth)) + " = ${i0} + ${i%d};" % (depth - 1))
+    lines += ["//:}"] * depth
+    return {"template": "\n".join(lines), "globals": {"n": width},
+            "scope": {f"i{level}": 1 for level in range(depth)}}
+
+def workload_if_chain(scale): #wide if/elsif chain inside a loop
+    branches = 32
+    lines = ["//:for($i=0;$i<$n;$i++) {", "//:if($i % $w == 0) {", "  assign b0 = ${i};"]
+    for branch in range(1, branches):
+        lines += [f"//:elsif($i % $w == {branch}) {{", f"  assign b{branch} = ${{i}};"]
+    lines += ["//:else {", "  assign none = ${i};", "//:}"]
+    lines += ["//:}"] * branches
+    lines += ["//:}"]
+    return {"template": "\n".join(lines), "globals": {"n": 1000 * scale, "w": branches + 1}, "scope": {"i": 7}}
+
+def workload_indexed_subst(scale): #list indexed substitutions ${test[${i}][${j}]}
+    rows, cols = 100 * scale, 50
+    table = [[row * cols + col for col in range(cols)] for row in range(rows)]
+    lines = ["//:for($i=0;$i<len($test);$i++) {",
+             "//:for($j=0;$j<len($test[$i]);$j++) {",
+             "assign value_${test[${i}][${j}]} = ${names[${j}]} + ${test[${i}][${j}]};",
+             "//:}",
+             "//:}"]
+    return {"template": "\n".join(lines), "globals": {"test": table, "names": [f"n{col}" for col in range(cols)]},
+            "scope": {"i": 1, "j": 1}}
+
+def workload_macro_header(scale): #huge layered `define header fed through SVMacroParser
+    count = 5000 * scale
+    header = ["`define M0 1", "`define WIDTH 32", "`define ADD(a,b) ((a)+(b))"]
+    for index in range(1, count):
+        if index % 10 == 0: #chains of 10 on top of a function-like macro
+            header.append(f"`define M{index} `ADD(`WIDTH, {index}) // layered")
+        else:
+            header.append(f"`define M{index} `M{index - 1}")
+        if index % 100 == 0:
+            header += [f"`ifdef M{index - 1}", f"`define F{index} 1 \\", "  + 1", "`endif", f"/* block {index} */"]
+    lines = ["//:$include = \"{header}\"", "//:for($i=0;$i<10;$i++) {", "wire [${M%d}:0] w_${i};" % (count - 1), "//:}"]
+    return {"template": "\n".join(lines), "globals": {}, "scope": {"i": 1}, "header": "\n".join(header)}
+
+WORKLOADS = {
+    "nested_for": workload_nested_for,
+    "if_chain": workload_if_chain,
+    "indexed_subst": workload_indexed_subst,
+    "macro_header": workload_macro_header,
+}
+STAGES = ("macro_parse", "template_parse", "expression_eval", "text_substitution", "render", "compiled_render")
+
+
+def _expressions(nodes): #every expression of a parsed template
+    for node in nodes:
+        if isinstance(node, expand_gen.ForBlock):
+            yield node.init_expr
+            yield node.cond_expr
+            yield from _expressions(node.body)
+        elif isinstance(node, expand_gen.IfBlock):
+            for condition, body in node.branches:
+                yield condition
+                yield from _expressions(body)
+        elif isinstance(node, expand_gen.Assignment):
+            expr = node.directive.split("=", 1)[1].strip().rstrip(";")
+            if not expr.startswith('"'): #skip $include = "file"
+                yield expr
+
+def _text_lines(nodes):
+    for node in nodes:
+        if isinstance(node, expand_gen.TextLine):
+            yield node.text
+        elif isinstance(node, expand_gen.ForBlock):
+            yield from _text_lines(node.body)
+        elif isinstance(node, expand_gen.IfBlock):
+            for _, body in node.branches:
+                yield from _text_lines(body)
+
+
+def run_stage(job): #run in a fresh worker process, caches left by other stages don't count
+    name, stage, scale, repeat = job
+    workload = WORKLOADS[name](scale)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        template = workload["template"]
+        header_path = None
+        if "header" in workload:
+            header_path = os.path.join(tmp_dir, "bench_header.svh")
+            with open(header_path, "w") as file:
+                file.write(workload["header"])
+            template = template.replace("{header}", header_path.replace("\\", "/"))
+        nodes = expand_gen.TemplateParser().parse(template)
+        scope = expand_gen.Scope(expand_gen.Scope(None, workload["globals"]), dict(workload["scope"]))
+        generator = expand_gen.CodeGenerator(scope=scope)
+        expressions = list(_expressions(nodes))
+        texts = list(_text_lines(nodes))
+        if stage == "macro_parse":
+            if header_path is None:
+                return None
+            units = workload["header"].count("\n") + 1
+            step = lambda: expand_gen.SVMacroParser().parse_file(header_path)
+        elif stage == "template_parse":
+            units = template.count("\n") + 1
+            step = lambda: expand_gen.TemplateParser().parse(template)
+        elif stage == "expression_eval":
+            rounds = 2000
+            units = rounds * len(expressions)
+            def step():
+                for _ in range(rounds):
+                    for expr in expressions:
+                        generator.eval_expr(expr)
+        elif stage == "text_substitution":
+            rounds = 2000
+            units = rounds * len(texts)
+            def step():
+                for _ in range(rounds):
+                    for text in texts:
+                        generator.replace_vars(text)
+        else: #render with the interpreter or the transpiled template
+            source = expand_gen.TemplateCompiler().compile(nodes)
+            compiled = expand_gen.CompiledTemplate(compile(source, "<svp bench>", "exec"))
+            units = 0
+            def step():
+                nonlocal units
+                units = 0
+                generator = expand_gen.CodeGenerator(global_vars=workload["globals"], echo=False) #no include print
+                lines = generator.stream(nodes) if stage == "render" else compiled.stream(generator)
+                for _ in lines:
+                    units += 1
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            step()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        tracemalloc.start() #one more untimed run, peak of what the stage itself allocates
+        step()
+        peak_kb = tracemalloc.get_traced_memory()[1] // 1024
+        tracemalloc.stop()
+    return {"wall_s": best, "peak_kb": peak_kb, "units": units,
+            "lines_per_s": units / best if best else None}
+
+
+def run_benchmarks(workloads, stages, scale=1, repeat=3):
+    results = {}
+    for name in workloads:
+        for stage in stages:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=1) as executor: #fresh process per stage
+                result = executor.submit(run_stage, (name, stage, scale, repeat)).result()
+            if result is not None:
+                results[f"{name}/{stage}"] = result
+                print(f"{name + '/' + stage:<36} {result['wall_s']:9.4f}s {result['peak_kb']:>8} KB "
+                      f"{result['lines_per_s']:14.0f} lines/s")
+    return results
+
+
+def compare(results, baseline, threshold): #list of regressions beyond threshold
+    regressions = []
+    for key, result in results.items():
+        old = baseline.get("results", {}).get(key)
+        if not old or not old.get("wall_s"):
+            continue
+        ratio = result["wall_s"] / old["wall_s"]
+        if ratio > 1 + threshold:
+            regressions.append((key, old["wall_s"], result["wall_s"], ratio))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark expand_gen.py on synthetic SVP workloads.')
+    parser.add_argument('-w', '--workload', action='append', choices=sorted(WORKLOADS),
+                        help='Workload to run (default: all)')
+    parser.add_argument('-s', '--stage', action='append', choices=STAGES, help='Stage to run (default: all)')
+    parser.add_argument('--scale', type=int, default=1, help='Workload size multiplier')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per stage, the best one is kept')
+    parser.add_argument('-o', '--output', help='Write the results as JSON')
+    parser.add_argument('--baseline', help='JSON results to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='Allowed slowdown against the baseline (0.2 = 20%%)')
+    args = parser.parse_args()
+    results = run_benchmarks(args.workload or list(WORKLOADS), args.stage or list(STAGES), args.scale, args.repeat)
+    report = {"meta": {"python": platform.python_version(), "platform": platform.platform(),
+                       "scale": args.scale, "repeat": args.repeat},
+              "results": results}
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=1, sort_keys=True)
+        print(f"Results: {args.output}")
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        regressions = compare(results, baseline, args.threshold)
+        for key, old, new, ratio in regressions:
+            print(f"REGRESSION {key}: {old:.4f}s -> {new:.4f}s ({(ratio - 1) * 100:.0f}% slower)")
+        if regressions:
+            sys.exit(1)
+        print(f"No regression beyond {args.threshold * 100:.0f}% against {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,106 +1,345 @@
 import re
 import sys
+import functools
+import collections
 import ast
 import os
-import argparse
-import traceback
+import io
+import time
+import contextlib
+import copy
+import hashlib
+import builtins
+import itertools
+import marshal
+import types
+#argparse, json, csv, sqlite3, socket, select, concurrent.futures and traceback are imported where they are used,
+#so an embedding host importing expand_gen for Session doesn't pay for the command line tools
+
+MACRO_REF = re.compile(r'`(\w+)')
+PREPROCESS_CHUNK = 1 << 18 #header characters read at a time
+COMMENT = re.compile(r'//[^\n]*|/\*.*?\*/', re.DOTALL)
+COMMENT_OR_STRING = re.compile(r'//[^\n]*|/\*(?:.*?(\*/)|.*)|"(?:[^"\\\n]|\\.)*(")?', re.DOTALL) #group 1/2: closed
+
+class ExpandError(Exception): #a template can't be expanded, raised instead of exiting so an embedding host survives
+    pass
+
+class TemplateSyntaxError(ExpandError, ValueError): #bad for/if/elsif/else directive
+    pass
+
+class ExpressionError(ExpandError): #an expression failed to evaluate
+    pass
+
+class AssignmentError(ExpandError): #//:$ line that is not $var = expr
+    pass
+
+class LoopLimitError(ExpandError): #a for loop ran more than max_iterations
+    pass
+
+class EngineMismatchError(ExpandError): #--engine check, the compiled engine disagrees with the interpreter
+    pass
+
+
+class DirectoryIndex: #file names of each directory, listed once instead of a stat per include candidate
+    def __init__(self):
+        self.listings = {} #directory -> frozenset of file names
+
+    def isfile(self, path):
+        directory, name = os.path.split(path)
+        names = self.listings.get(directory)
+        if names is None:
+            try:
+                with os.scandir(directory or os.curdir) as entries:
+                    names = frozenset(entry.name for entry in entries if entry.is_file())
+            except OSError:
+                names = frozenset()
+            self.listings[directory] = names
+        return name in names
+
+    def clear(self):
+        self.listings.clear()
+
+def _include_resolves(name, dirs): #path of an include name in search dirs that did not hold it, None while they still don't
+    if os.path.isabs(name):
+        return name if os.path.isfile(name) else None
+    for path in dirs:
+        abs_path = os.path.normpath(os.path.join(path, name))
+        if os.path.isfile(abs_path):
+            return abs_path
+    return None
+
 
 class SVMacroParser: #get include path info 
-    def __init__(self, include_paths=None):
-        self.include_paths = set()
+    def __init__(self, include_paths=None, directories=None):
+        self.include_paths = [] #search order: cwd, the given +incdir+ paths, then the folders of found files
+        self.directories = directories if directories is not None else DirectoryIndex()
+        self._lookups = {} #include name -> abs path, None when not found
+        self.missing = {} #include name -> search dirs tried that did not hold it, see _include_resolves
         self.macros = {}
+        self.macro_params = {} #function-like macro -> (param text, param names, defaults, expanded body)
         self.processed_files = set()
+        self._dirty = {} #macros defined since the last expansion (ordered)
+        self._waiting = {} #undefined macro -> macros whose value still reference it
         self.cond_stack = []
         self.current_active = True
-        self.include_paths.add(os.getcwd())
+        self.warn = print #warnings and read errors, MacroStore collects them to show them again on a cache hit
+        self.add_include_path(os.getcwd())
         if include_paths:
             if isinstance(include_paths, (list, tuple)):
-                self.include_paths.update(include_paths)
+                for path in include_paths:
+                    self.add_include_path(path)
             else:
-                self.include_paths.add(include_paths)
+                self.add_include_path(include_paths)
+
+    def add_include_path(self, path): #searched after the ones already known
+        path = os.path.normpath(os.path.abspath(path))
+        if path not in self.include_paths:
+            self.include_paths.append(path)
+            self._lookups = {name: found for name, found in self._lookups.items() if found is not None}
 
     def parse_file(self, filename):
         abs_file = self._resolve_path(filename)
         if not abs_file:
-            print(f"Warning: Invalid File '{filename}' ")
+            self.warn(f"Warning: Invalid File '{filename}' ")
         if abs_file in self.processed_files: #file have repeat
             return self.macros
         self.processed_files.add(abs_file)
         try:
-            with open(abs_file, 'r') as f:
-                content = f.read()
+            file = open(abs_file, 'r')
         except Exception as e:
-            print(f"Error reading file {abs_file}: {str(e)}")
+            self.warn(f"Error reading file {abs_file}: {str(e)}")
             return self.macros
-        lines = self._preprocess_content(content)
-        self._process_lines(lines)
+        with file: #directive lines are processed while the file is read
+            try:
+                self._process_lines(self._preprocess(file))
+            except (OSError, UnicodeDecodeError) as e:
+                self.warn(f"Error reading file {abs_file}: {str(e)}")
+                return self.macros
         if not self.cond_stack:
             self._expand_macros()
         return self.macros
 
 
     def _resolve_path(self, filename):
+        abs_path = self._find(filename)
+        if abs_path is None:
+            self.warn(f"Warning: Invalid File '{os.path.expandvars(filename)}' ")
+            return None
+        self.add_include_path(os.path.dirname(abs_path))
+        return abs_path
+
+    def _find(self, filename): #abs path or None, looked up once per include name
         filename = os.path.expandvars(filename)
-        if os.path.isabs(filename) and os.path.isfile(filename):
-            filename = os.path.abspath(filename)
-            self.include_paths.add(os.path.dirname(filename))
-            return os.path.normpath(filename)
-        for path in self.include_paths:
-            abs_path = os.path.join(path, filename)
-            if os.path.isfile(abs_path):
-                abs_path = os.path.abspath(abs_path)
-                self.include_paths.add(os.path.dirname(abs_path))
-                return os.path.normpath(abs_path)
-        print(f"Warning: Invalid File '{filename}' ")
+        if filename not in self._lookups:
+            self._lookups[filename] = self._search(filename)
+        return self._lookups[filename]
+
+    def _search(self, filename): #first include path holding the file, the ones before it go to missing
+        if os.path.isabs(filename):
+            abs_path = os.path.normpath(filename)
+            if self.directories.isfile(abs_path):
+                return abs_path
+            self._missed(filename, ())
+            return None
+        for index, path in enumerate(self.include_paths):
+            abs_path = os.path.normpath(os.path.join(path, filename))
+            if self.directories.isfile(abs_path):
+                if index: #a file created in one of them later would be found instead
+                    self._missed(filename, tuple(self.include_paths[:index]))
+                return abs_path
+        self._missed(filename, tuple(self.include_paths))
         return None
 
-    def _preprocess_content(self, content):
-        content = re.sub(r'/\*.*?\*/', '', content, flags=re.DOTALL) #remove comment
-        content = re.sub(r'//.*$', '', content, flags=re.MULTILINE) #remove comment
+    def _missed(self, filename, dirs):
+        self.missing[filename] = tuple(dict.fromkeys(self.missing.get(filename, ()) + tuple(dirs)))
 
-        lines = []
-        current_line = ""
-        for line in content.splitlines():
+    @staticmethod
+    def _clean_lines(file): #physical lines without comments, the file is read in chunks, strings kept as they are
+        partial = "" #cleaned start of a line going on in the next chunk
+        carry = "" #raw text left for the next chunk
+        while True:
+            chunk = file.read(PREPROCESS_CHUNK)
+            final = not chunk
+            buffer = carry + chunk
+            carry = ""
+            if not final: #whole lines only, so a // or /* is never cut in two
+                cut = buffer.rfind('\n') + 1
+                buffer, carry = buffer[:cut], buffer[cut:]
+            if '"' not in buffer: #no string, comments go in one pass
+                cleaned = COMMENT.sub('', buffer)
+                unclosed = cleaned.find('/*') #a /* without */ comments out the rest
+                if unclosed >= 0:
+                    cleaned = cleaned[:unclosed]
+                    if not final:
+                        carry = "/*" + carry
+                partial = yield from SVMacroParser._split_lines(partial + cleaned)
+                if final:
+                    break
+                continue
+            out = [partial]
+            pos = 0
+            for match in COMMENT_OR_STRING.finditer(buffer):
+                out.append(buffer[pos:match.start()])
+                pos = match.end()
+                if not final and pos == len(buffer) and match.group(1) is None and match.group(2) is None:
+                    #block comment or string running into the next chunk, a comment body is not kept
+                    carry = ("/*" if match.group(0).startswith("/*") else match.group(0)) + carry
+                    break
+                if match.group(0)[0] == '"':
+                    out.append(match.group(0))
+            else:
+                out.append(buffer[pos:])
+            partial = yield from SVMacroParser._split_lines(''.join(out)) #block comment newlines go with it
+            if final:
+                break
+        yield from partial.splitlines()
+
+    @staticmethod
+    def _split_lines(text): #yield the complete lines, return the unfinished last one
+        end = text.rfind('\n')
+        if end >= 0:
+            yield from text[:end].splitlines()
+        return text[end + 1:]
+
+    def _preprocess(self, file): #directive lines of a file, cross line defines joined
+        current_line = "" #line ending with a backslash
+        for line in self._clean_lines(file):
             stripped = line.strip()
             if not stripped:
                 continue
-            if current_line:
-                if current_line.endswith('\\'): #support cross line define
-                    current_line = current_line.rstrip('\\').rstrip() + ' ' + stripped
-                else:
-                    lines.append(current_line)
-                    current_line = stripped
-            else:
-                current_line = stripped
-            if not current_line.endswith('\\'):
-                lines.append(current_line)
+            if current_line: #support cross line define
+                stripped = current_line.rstrip('\\').rstrip() + ' ' + stripped
                 current_line = ""
-        if current_line:
-            lines.append(current_line)
-        return lines
+            if stripped.endswith('\\'):
+                current_line = stripped
+            elif stripped.startswith('`'):
+                yield stripped
+        if current_line.startswith('`'):
+            yield current_line
+
+    def snapshot(self): #parser state after a parse, see MacroStore
+        return (dict(self.macros), dict(self.macro_params), frozenset(self.processed_files),
+                {name: set(users) for name, users in self._waiting.items()}, tuple(self.include_paths),
+                dict(self.missing))
 
-    def _expand_macros(self):
-        original_macros = self.macros.copy()
-        expanding_stack = []
-        def expand_value(value, macro_name):
-            if macro_name in expanding_stack:
-                print(f"Error: Circular macro reference detected in '{macro_name}'")
-                return value
-            expanding_stack.append(macro_name)
-            def replace_macro(match):
-                ref_name = match.group(1)
-                if '(' in match.group(0): #if macro has () keep it
-                    return match.group(0)
-                if ref_name in original_macros:
-                    return expand_value(original_macros[ref_name], ref_name)
+    def restore(self, state):
+        macros, macro_params, processed_files, waiting, include_paths, missing = state
+        self.macros = dict(macros)
+        self.macro_params = dict(macro_params)
+        self.processed_files.update(processed_files)
+        for path in include_paths:
+            self.add_include_path(path)
+        self._waiting = {name: set(users) for name, users in waiting.items()}
+        self._dirty = {}
+        for name, dirs in missing.items():
+            self._missed(name, dirs)
+
+    def _expand_macros(self): #expand the new macros in dependency order, each one once
+        work = dict(self._dirty)
+        for name in self._dirty: #macros waiting for a now defined one
+            for user in self._waiting.pop(name, ()):
+                work[user] = None
+        self._dirty = {}
+        state = {} #macro -> False while expanding, True when done
+        cyclic = set()
+        for root in work:
+            if root in state:
+                continue
+            state[root] = False
+            stack = [(root, iter(MACRO_REF.findall(self._macro_body(root))))]
+            while stack:
+                name, refs = stack[-1]
+                for ref in refs:
+                    if ref in work and ref in self.macros:
+                        if ref not in state: #expand the referenced macro first
+                            state[ref] = False
+                            stack.append((ref, iter(MACRO_REF.findall(self._macro_body(ref)))))
+                            break
+                        if state[ref] is False:
+                            self.warn(f"Error: Circular macro reference detected in '{ref}'")
+                            names = [entry[0] for entry in stack]
+                            cyclic.update(names[names.index(ref):])
                 else:
-                    return match.group(0)
-            pattern = r'`(\w+)(\([^)]*\))?'
-            expanded = re.sub(pattern, replace_macro, value)
-            expanding_stack.pop()
-            return expanded
-        for name, value in self.macros.items():
-            self.macros[name] = expand_value(value, name)
+                    stack.pop()
+                    self._set_macro_body(name, self._substitute(self._macro_body(name), name, work, state, cyclic))
+                    state[name] = True
+
+    def _macro_body(self, name):
+        if name in self.macro_params:
+            return self.macro_params[name][3]
+        return self.macros[name]
+
+    def _set_macro_body(self, name, body):
+        if name in self.macro_params:
+            text, params, defaults, _ = self.macro_params[name]
+            self.macro_params[name] = (text, params, defaults, body)
+            self.macros[name] = text + " " + body
+        else:
+            self.macros[name] = body
+
+    def _substitute(self, value, user, work=(), state=None, cyclic=()): #replace `ref and `FUNC(a,b) by the expanded values
+        out = []
+        pos = 0
+        while True:
+            match = MACRO_REF.search(value, pos)
+            if not match:
+                out.append(value[pos:])
+                return ''.join(out)
+            out.append(value[pos:match.start()])
+            ref = match.group(1)
+            pos = match.end()
+            if ref not in self.macros:
+                self._waiting.setdefault(ref, set()).add(user) #expand again once it is defined
+                out.append(match.group(0))
+            elif ref in work and (state.get(ref) is not True or (ref in cyclic and user in cyclic)): #circular, keep it
+                out.append(match.group(0))
+            elif ref in self.macro_params:
+                call = self._split_call(value, pos) if pos < len(value) and value[pos] == '(' else None
+                if call is None: #function-like macro without arguments, keep it
+                    out.append(match.group(0))
+                    continue
+                args, pos = call
+                args = [self._substitute(arg, user, work, state, cyclic) for arg in args]
+                out.append(self._apply_macro(ref, args, value[match.start():pos]))
+            else:
+                out.append(self.macros[ref])
+
+    @staticmethod
+    def _split_call(value, pos): #value[pos] is '(' -> ([args], index after ')') or None
+        args = []
+        depth = 0
+        start = pos + 1
+        for index in range(pos, len(value)):
+            char = value[index]
+            if char in '([{':
+                depth += 1
+            elif char in ')]}':
+                depth -= 1
+                if depth == 0:
+                    args.append(value[start:index].strip())
+                    return args, index + 1
+            elif char == ',' and depth == 1:
+                args.append(value[start:index].strip())
+                start = index + 1
+        return None #unbalanced
+
+    def _apply_macro(self, name, args, text):
+        _, params, defaults, body = self.macro_params[name]
+        if args == [''] and not params:
+            args = []
+        if len(args) > len(params):
+            self.warn(f"Warning: Too many arguments for macro '{name}': {text}")
+            return text
+        values = {}
+        for index, param in enumerate(params):
+            arg = args[index] if index < len(args) and args[index] != '' else defaults[index]
+            if arg is None:
+                self.warn(f"Warning: Missing argument '{param}' for macro '{name}': {text}")
+                return text
+            values[param] = arg
+        if not values:
+            return body
+        return re.sub(r'\b(' + '|'.join(map(re.escape, values)) + r')\b', lambda m: values[m.group(1)], body)
 
 
     def _process_lines(self, lines):
@@ -116,43 +355,53 @@ class SVMacroParser: #get include path info
                     include_file = match.group(1).strip('"')
                     self._process_include(include_file)
                 else:
-                    print(f"Warning: Invalid include syntax: {line}")
+                    self.warn(f"Warning: Invalid include syntax: {line}")
             elif cmd in ("ifdef", "ifndef"):
                 macro_name = args.split()[0] if args else ""
                 if not macro_name:
-                    print(f"Warning: Missing macro name in {line}")
+                    self.warn(f"Warning: Missing macro name in {line}")
                     continue
                 cond = (macro_name in self.macros) if cmd == "ifdef" else (macro_name not in self.macros)
                 self.cond_stack.append((self.current_active, cond, False))
                 self.current_active = self.current_active and cond
             elif cmd == "else":
                 if not self.cond_stack:
-                    print(f"Warning: `else without matching `ifdef/`ifndef: {line}")
+                    self.warn(f"Warning: `else without matching `ifdef/`ifndef: {line}")
                     continue
                 outer_active, cond, else_seen = self.cond_stack[-1]
                 if else_seen:
-                    print(f"Warning: Multiple `else for same `ifdef/`ifndef: {line}")
+                    self.warn(f"Warning: Multiple `else for same `ifdef/`ifndef: {line}")
                 else:
                     self.cond_stack[-1] = (outer_active, cond, True)
                     self.current_active = outer_active and not cond
             elif cmd == "endif":
                 if not self.cond_stack:
-                    print(f"Warning: `endif without matching `ifdef/`ifndef: {line}")
+                    self.warn(f"Warning: `endif without matching `ifdef/`ifndef: {line}")
                 else:
                     self.current_active, _, _ = self.cond_stack.pop()
             elif self.current_active and cmd == "define":
-                match = re.match(r'^\s*(\w+)(?:\s*\(([^)]*)\))?\s*(.*)$', args)
+                match = re.match(r'^\s*(\w+)(?:\(([^)]*)\))?\s*(.*)$', args) #FUNC( only without space
                 if not match:
-                    print(f"Warning: Invalid macro definition: {line}")
+                    self.warn(f"Warning: Invalid macro definition: {line}")
                     continue
                 macro_name = match.group(1)
                 params = match.group(2).strip() if match.group(2) else None
                 macro_value = match.group(3).strip()
-                if params:
-                    macro_value = params + " "+macro_value
                 if macro_name in self.macros:
-                    print(f"Warning: '{macro_name}' redefined from '{self.macros[macro_name]}' to '{macro_value}'")
-                self.macros[macro_name] = macro_value #all_macros.update({})
+                    shown = params + " " + macro_value if params else macro_value
+                    self.warn(f"Warning: '{macro_name}' redefined from '{self.macros[macro_name]}' to '{shown}'")
+                if params: #`define FUNC(a,b=1) a+b
+                    names, defaults = [], []
+                    for param in params.split(','):
+                        param_name, _, default = param.partition('=')
+                        names.append(param_name.strip())
+                        defaults.append(default.strip() if _ else None)
+                    self.macro_params[macro_name] = (params, tuple(names), tuple(defaults), macro_value)
+                    self.macros[macro_name] = params + " " + macro_value
+                else:
+                    self.macro_params.pop(macro_name, None)
+                    self.macros[macro_name] = macro_value #all_macros.update({})
+                self._dirty[macro_name] = None
 
 
     def _process_include(self, filename):
@@ -161,71 +410,545 @@ class SVMacroParser: #get include path info
             self.parse_file(abs_path)
 
 
+class MacroStore: #one per run, shared by every generator: parsed .svh keyed by path, mtime and defines in effect
+    def __init__(self, index=None, include_dirs=()):
+        self.include_dirs = list(include_dirs) #-I, searched in order after the working directory
+        self.directories = DirectoryIndex() #directory listings shared by the parsers of the run
+        self.resolved = {} #include name -> abs path
+        self.mtimes = {} #abs path -> mtime, stat once per run
+        self.results = {} #(abs path, mtime, defines in effect) -> (parser snapshot, console output)
+        self.index = index #MacroIndex shared with later runs, or None
+        self.hits = 0
+        self.misses = 0
+        self.index_hits = 0
+
+    def parser(self): #new SVMacroParser using the include dirs and directory listings of the run
+        return SVMacroParser(self.include_dirs, self.directories)
+
+    def parse_file(self, parser, filename, echo=True): #same result as parser.parse_file(filename), parsed once per run
+        abs_file = self.resolved.get(filename)
+        if abs_file is None:
+            abs_file = parser._find(filename)
+            if abs_file is None: #let the parser report it
+                return self._parse(parser, filename, parser.warn if echo else lambda message: None)
+            self.resolved[filename] = abs_file
+        if abs_file in parser.processed_files: #file have repeat
+            return parser.macros
+        mtime = self.mtimes.get(abs_file)
+        if mtime is None:
+            mtime = self.mtimes[abs_file] = os.stat(abs_file).st_mtime_ns
+        key = (abs_file, mtime, frozenset(parser.macros.items()))
+        result = self.results.get(key)
+        if result is not None:
+            self.hits += 1
+            parser.restore(result[0])
+        else:
+            index_key = self.index.key(parser, abs_file) if self.index is not None else None
+            result = self.index.get(index_key) if index_key is not None else None
+            if result is not None:
+                self.index_hits += 1
+                parser.restore(result[0])
+            else:
+                self.misses += 1
+                known = set(parser.processed_files)
+                missing = dict(parser.missing)
+                console = [] #warnings are kept and shown again on every hit
+                self._parse(parser, abs_file, console.append)
+                result = (parser.snapshot(), "".join(message + "\n" for message in console))
+                if index_key is not None:
+                    self.index.put(index_key, parser.processed_files - known,
+                                   {name: dirs for name, dirs in parser.missing.items() if missing.get(name) != dirs},
+                                   *result)
+            self.results[key] = result
+        if echo:
+            sys.stdout.write(result[1])
+        return parser.macros
+
+    @staticmethod
+    def _parse(parser, filename, warn): #parser.parse_file with its warnings sent to warn
+        saved = parser.warn
+        parser.warn = warn
+        try:
+            return parser.parse_file(filename)
+        finally:
+            parser.warn = saved
+
+    def refresh(self, changed=None): #files may have changed since, None drops every parsed header
+        self.resolved.clear()
+        self.mtimes.clear()
+        self.directories.clear()
+        if self.index is not None:
+            self.index.hashes.clear()
+        if changed is None:
+            self.results.clear()
+        else: #keep the headers that read none of the changed files and still miss the includes they missed
+            changed = set(changed)
+            self.results = {key: result for key, result in self.results.items()
+                            if key[0] not in changed and not changed & result[0][2]
+                            and not any(_include_resolves(name, dirs) for name, dirs in result[0][5].items())}
+
+
+MACRO_INDEX_MAX_AGE = 30 * 24 * 3600 #seconds an unused index entry is kept
+
+def default_macro_index():
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_home, "expand_gen", "macro_index.sqlite")
+
+
+class MacroIndex: #MacroStore results on disk, reused by later runs while every header parsed hashes the same
+    def __init__(self, path):
+        self.path = path
+        self.hashes = {} #abs path -> content hash, once per run
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        import sqlite3
+        self.db = sqlite3.connect(path, timeout=60)
+        self.db.executescript("""
+            PRAGMA journal_mode=WAL;
+            PRAGMA synchronous=OFF;
+            CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, mtime INTEGER, size INTEGER, hash TEXT);
+            CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, files BLOB, state BLOB, output TEXT, used REAL);
+        """)
+        with self.db:
+            self.db.execute("DELETE FROM results WHERE used < ?", (time.time() - MACRO_INDEX_MAX_AGE,))
+
+    @classmethod
+    def open(cls, path): #None when there is no path or the index can't be opened
+        if not path:
+            return None
+        try:
+            import sqlite3
+        except ImportError: #some python builds lack it
+            print("Warning: sqlite3 is not available, macro index disabled")
+            return None
+        try:
+            return cls(path)
+        except (OSError, sqlite3.Error) as e:
+            print(f"Warning: can't open macro index {path}: {e}")
+            return None
+
+    def file_hash(self, path): #content hash, the stat of the last hash saves reading unchanged files
+        digest = self.hashes.get(path)
+        if digest is None:
+            try:
+                stat = os.stat(path)
+            except (OSError, TypeError):
+                return None
+            row = self.db.execute("SELECT mtime, size, hash FROM files WHERE path = ?", (path,)).fetchone()
+            if row is not None and row[0] == stat.st_mtime_ns and row[1] == stat.st_size:
+                digest = row[2]
+            else:
+                digest = _file_hash(path)
+                with self.db:
+                    self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+                                    (path, stat.st_mtime_ns, stat.st_size, digest))
+            self.hashes[path] = digest
+        return digest
+
+    def key(self, parser, abs_file): #the header and everything in the parser that changes its result
+        digest = self.file_hash(abs_file)
+        if digest is None:
+            return None
+        state = (_engine_hash(), abs_file, digest, sorted(parser.macros.items()),
+                 sorted(parser.processed_files, key=str), parser.include_paths,
+                 sorted((name, sorted(users)) for name, users in parser._waiting.items()))
+        return hashlib.sha256(repr(state).encode()).hexdigest()
+
+    def get(self, key): #(snapshot, output) or None, also when a header it read has changed or an include resolves elsewhere
+        row = self.db.execute("SELECT files, state, output FROM results WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        files, state, output = row
+        files, missing = marshal.loads(files)
+        for path, digest in files.items():
+            if self.file_hash(path) != digest:
+                return None
+        for name, dirs in missing.items():
+            if _include_resolves(name, dirs):
+                return None
+        with self.db:
+            self.db.execute("UPDATE results SET used = ? WHERE key = ?", (time.time(), key))
+        return marshal.loads(state), output
+
+    def put(self, key, files, missing, snapshot, output): #missing: include name -> search dirs that did not hold it
+        files = {path: self.file_hash(path) for path in files if path}
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)",
+                            (key, marshal.dumps((files, missing)), marshal.dumps(snapshot), output, time.time()))
+
+
+VAR_LOOKUP = "__svp_vars__" #name of the variable table inside compiled expressions
+VAR_REF = re.compile(r'\$\{?(\w+)\}?') #$var or ${var} in an expression
+STRING_LITERAL = re.compile(r'''([rRbBuU]{0,2})("(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')''')
+
+@functools.lru_cache(maxsize=4096)
+def _text_value(text): #(value, code) of a string read by an expression, code when each read needs a new object
+    try:
+        code = compile(text.strip(), "<svp-value>", "eval")
+        value = eval(code, {"__builtins__": {}}, {})
+    except Exception: #not an expression, it stays a string
+        return text, None
+    if value.__class__ in (int, float, bool, str, complex, type(None)):
+        return value, None
+    return None, code
+
+def expr_value(value): #$var in an expression reads like its text pasted in: macro '9' is 9, '0' is false
+    if value.__class__ is not str:
+        return value
+    value, code = _text_value(value)
+    return value if code is None else eval(code, {"__builtins__": {}}, {})
+
+
+class ExprCache: #expression string -> code object, bounded LRU shared by all generators
+    def __init__(self, maxsize=4096):
+        self.compile = functools.lru_cache(maxsize=maxsize)(self._compile)
+
+    @staticmethod
+    def _literal(match): #"${p}_x" -> ("" + text of p + "_x"), the value pasted like the old text replace
+        prefix, literal = match.groups()
+        quote, body = literal[0], literal[1:-1]
+        encode = ".encode()" if 'b' in prefix.lower() else ""
+        parts = []
+        pos = 0
+        for ref in VAR_REF.finditer(body):
+            parts.append(ExprCache._piece(prefix, quote, body[pos:ref.start()]))
+            parts.append(f"{VAR_LOOKUP}.text('{ref.group(1)}'){encode}")
+            pos = ref.end()
+        if not parts:
+            return match.group(0)
+        parts.append(ExprCache._piece(prefix, quote, body[pos:]))
+        return "(" + " + ".join(parts) + ")"
+
+    @staticmethod
+    def _piece(prefix, quote, text): #literal of the text between two $var of a string literal
+        if 'r' in prefix.lower(): #no escapes, but a raw literal can't end with a backslash
+            return repr(text.encode() if 'b' in prefix.lower() else text)
+        if (len(text) - len(text.rstrip('\\'))) % 2: #"a\${w}": the backslash stays a backslash
+            text += '\\'
+        return f"{prefix}{quote}{text}{quote}"
+
+    @staticmethod
+    def rewrite(expr): #rewrite $var/${var} into a variable lookup and sv op into py op
+        lookup = lambda m: f"{VAR_LOOKUP}.value('{m.group(1)}')"
+        out = []
+        pos = 0
+        for match in STRING_LITERAL.finditer(expr): #a string literal keeps its text, only its $var are pasted
+            out.append(VAR_REF.sub(lookup, expr[pos:match.start()]))
+            out.append(ExprCache._literal(match))
+            pos = match.end()
+        out.append(VAR_REF.sub(lookup, expr[pos:]))
+        expr = ''.join(out)
+        expr = re.sub(r'&&', ' and ', expr)
+        expr = re.sub(r'\|\|', ' or ', expr)
+        expr = re.sub(r'!(?!=)', ' not ', expr) # ! can replace != can't replace
+        expr = re.sub(r'~', ' not ', expr) #others e.g. +/-/*/% py already support
+        return expr.strip()
+
+    @staticmethod
+    def source(expr): #rewritten expression, reading copies of the variables when it may mutate them
+        source = ExprCache.rewrite(expr)
+        if expr_reads(expr) is None:
+            source = source.replace(f"{VAR_LOOKUP}.value(", f"{VAR_LOOKUP}.copy_value(")
+        return source
+
+    @staticmethod
+    def _compile(expr):
+        return compile(ExprCache.source(expr), "<svp-expr>", "eval")
+
+    @property
+    def hits(self):
+        return self.compile.cache_info().hits
+
+    @property
+    def misses(self):
+        return self.compile.cache_info().misses
+
+    def clear(self):
+        self.compile.cache_clear()
+
+
+class TraceEvent(collections.namedtuple("TraceEvent", "lineno depth directive bindings")):
+    __slots__ = ()
+
+    def format(self): #only called when the event is written out
+        items = " ".join(f"{key}={value!r}" for key, value in self.bindings.items())
+        return f"{'    ' * self.depth}[{self.lineno}] {self.directive}: {items}"
+
+
+class Tracer: #structured debug events, call sites check the tracer before building anything
+    def __init__(self, stream=None):
+        self.stream = stream #write each event as it happens, else keep them in events
+        self.events = []
+
+    def event(self, lineno, depth, directive, **bindings):
+        event = TraceEvent(lineno, depth, directive, bindings)
+        if self.stream is None:
+            self.events.append(event)
+        else:
+            self.stream.write(event.format() + "\n")
+
+    def lines(self):
+        return [event.format() for event in self.events]
+
+
+class Scope: #layered variables, a scope only holds what was written in it and reads fall back to the parent
+    __slots__ = ("parent", "vars")
+
+    def __init__(self, parent=None, vars=None):
+        self.parent = parent
+        self.vars = {} if vars is None else vars
+
+    def child(self):
+        return Scope(self)
+
+    def __getitem__(self, name):
+        scope = self
+        while scope is not None:
+            vars = scope.vars
+            if name in vars:
+                return vars[name]
+            scope = scope.parent
+        raise KeyError(name)
+
+    def get(self, name, default=None):
+        scope = self
+        while scope is not None:
+            vars = scope.vars
+            if name in vars:
+                return vars[name]
+            scope = scope.parent
+        return default
+
+    def value(self, name): #$name in an expression, 0 when it is not set
+        scope = self
+        while scope is not None:
+            vars = scope.vars
+            if name in vars:
+                value = vars[name]
+                return expr_value(value) if value.__class__ is str else value
+            scope = scope.parent
+        return 0
+
+    def text(self, name): #$name inside a string literal of an expression, '0' when it is not set
+        value = self.get(name, "0")
+        return value if value.__class__ is str else str(value)
+
+    def copy_value(self, name): #for an expression that may mutate it, pasted text of old was a new object too
+        return copy.deepcopy(self.value(name))
+
+    def __contains__(self, name):
+        scope = self
+        while scope is not None:
+            if name in scope.vars:
+                return True
+            scope = scope.parent
+        return False
+
+    def __setitem__(self, name, value):
+        self.vars[name] = value
+
+    def update(self, values):
+        self.vars.update(values)
+
+    def flatten(self): #plain dict of every visible variable
+        layers = []
+        scope = self
+        while scope is not None:
+            layers.append(scope.vars)
+            scope = scope.parent
+        result = {}
+        for vars in reversed(layers):
+            result.update(vars)
+        return result
+
+
+INDEX_CONST, INDEX_VAR, INDEX_EXPR = "const", "var", "expr" #kinds of list index in a text line
+
+@functools.lru_cache(maxsize=4096)
+def compile_text(line): #text line -> tuple of literal str and (var, indices, text) lookups, None if nothing to replace
+    if '${' not in line:
+        return None
+    parts = []
+    pos = 0
+    for match in re.finditer(r'\$\{(\w+)((?:\[[^\]]+\])*)\}', line):
+        if match.start() > pos:
+            parts.append(line[pos:match.start()])
+        indices = []
+        for index_expr in re.findall(r'\[([^\]]+)\]', match.group(2)): #support list index list[x]
+            simple = re.match(r'^\s*\$\{?(\w+)\}?\s*$', index_expr)
+            if simple:
+                indices.append((INDEX_VAR, simple.group(1)))
+            elif re.match(r'^\s*(0|[1-9]\d*)\s*$', index_expr):
+                indices.append((INDEX_CONST, int(index_expr)))
+            else:
+                indices.append((INDEX_EXPR, index_expr))
+        parts.append((match.group(1), tuple(indices), match.group(0)))
+        pos = match.end()
+    if pos < len(line):
+        parts.append(line[pos:])
+    return tuple(parts)
+
+
+MAX_LOOP_ITERATIONS = 1000000 #default limit of one for loop
+MEMO_MAX_ENTRIES = 1024 #expansions kept per loop body
+MEMO_MAX_LINES = 4096 #a longer expansion is streamed but not kept
+MEMO_MAX_TOTAL_LINES = 1 << 18 #lines kept by all the bodies of a render, a few tens of MB
+MEMO_MAX_MISSES = 32 #a body missing this often before its first hit is no longer keyed
+MISSING = object() #read variable that is not set
+KEY_BY_VALUE = {int, str, bool, type(None)} #str() is fixed by type and value, others are keyed by identity
+
+class LoopMemo: #expanded loop bodies of one render, keyed by the values of the variables each body reads
+    def __init__(self, by_id=False):
+        self.by_id = by_id #no expression of the template can mutate a value, so identity is a valid key
+        self.bodies = {} #ForBlock -> [{key: lines}, hits, misses], False once the body never repeated
+        self.kept = 0 #lines kept by every body, up to MEMO_MAX_TOTAL_LINES
+        self.pinned = {} #id -> value of the kept keys, an id is not reused while its value is alive
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, scope, names): #(key, values keyed by id) of the read variables, None if it can't be keyed
+        key = []
+        pins = []
+        for name in names:
+            value = scope.get(name, MISSING)
+            cls = value.__class__
+            if cls in KEY_BY_VALUE or value is MISSING: #1, 1.0 and True are equal but print differently
+                key.append(cls)
+                key.append(value)
+            elif self.by_id:
+                key.append(cls)
+                key.append(id(value))
+                pins.append(value)
+            else:
+                return None
+        return tuple(key), pins
+
+    def lines(self, node, generator): #one iteration of node's body, the kept expansion when its reads repeat
+        scope = generator.variables
+        state = self.bodies.get(node)
+        if state is None:
+            state = self.bodies[node] = [{}, 0, 0]
+        key = self.key(scope, node.reads) if state else None
+        if key is None:
+            return generator.child(scope.child()).execute(node.body)
+        key, pins = key
+        entries = state[0]
+        lines = entries.get(key)
+        if lines is not None:
+            state[1] += 1
+            self.hits += 1
+            return lines
+        self.misses += 1
+        state[2] += 1
+        if state[2] >= MEMO_MAX_MISSES and not state[1]: #every iteration differs, stop keying it
+            self.bodies[node] = False
+            self.kept -= sum(map(len, entries.values()))
+            entries.clear()
+            return generator.child(scope.child()).execute(node.body)
+        return self.record(entries, key, pins, generator.child(scope.child()).execute(node.body))
+
+    def record(self, entries, key, pins, lines): #pass the lines through, keep them once the body is done
+        kept = [] if self.kept < MEMO_MAX_TOTAL_LINES else None
+        for line in lines:
+            if kept is not None:
+                kept.append(line)
+                if len(kept) > MEMO_MAX_LINES:
+                    kept = None
+            yield line
+        if kept is not None and len(entries) < MEMO_MAX_ENTRIES and self.kept + len(kept) <= MEMO_MAX_TOTAL_LINES:
+            entries[key] = tuple(kept)
+            self.kept += len(kept)
+            for value in pins:
+                self.pinned[id(value)] = value
+
+
 class CodeGenerator: #recursion process the line 
-    def __init__(self, parent_vars=None, global_vars=None,debug=False):
-        self.variables = {} #variable priority: local variable > parents variable > global variable
-        if global_vars:
-            self.variables.update(global_vars)
-        if parent_vars:
-            self.variables.update(parent_vars)
-        self.macro_parse = SVMacroParser()
+    expr_cache = ExprCache() #shared by every generator of the run
+    memoize = True #reuse loop body expansions, off while tracing
+    def __init__(self, parent_vars=None, global_vars=None, debug=False, tracer=None, dependencies=None,
+                 macro_store=None, scope=None, max_iterations=None, unresolved=None, echo=True):
+        if scope is None: #variable priority: local variable > parents variable > global variable
+            scope = Scope(Scope(None, global_vars) if global_vars else None, dict(parent_vars or {}))
+        self.variables = scope
+        self._macro_parse = None #created on the first include of this generator
+        self.macro_store = macro_store if macro_store is not None else MacroStore()
+        self.dependencies = dependencies if dependencies is not None else set() #files opened by includes
+        self.unresolved = unresolved if unresolved is not None else {} #include names not found -> search dirs
+        self.echo = echo #print what each $include defines, and its header warnings
         self.output_lines = []  #output code 
-        self.debug = debug 
-        self.debug_log = []
-        self.debug_tab = 0
-    
-    def log(self,message):
-        if self.debug:
-            step = "    " * self.debug_tab
-            self.debug_log.append(f"{step}{message}")
+        if tracer is None and debug:
+            tracer = Tracer()
+        self.tracer = tracer #None when tracing is off
+        self.debug = tracer is not None
+        self.depth = 0 #nest depth for the trace
+        self.lineno = 0 #current template line for the trace
+        self.max_iterations = max_iterations or MAX_LOOP_ITERATIONS #a runaway for loop fails fast
+        self.memo = None #LoopMemo of the render, set by stream
+
+    @property
+    def macro_parse(self):
+        if self._macro_parse is None:
+            self._macro_parse = self.macro_store.parser()
+        return self._macro_parse
+
+    def child(self, scope): #generator for a nested block, reading and writing the given scope
+        generator = self.__class__(tracer=self.tracer, dependencies=self.dependencies,
+                                  macro_store=self.macro_store, scope=scope, max_iterations=self.max_iterations,
+                                  unresolved=self.unresolved, echo=self.echo)
+        generator.depth = self.depth + 1
+        generator.lineno = self.lineno
+        generator.memo = self.memo
+        return generator
 
     def eval_expr(self, expr, local_vars=None): #do opc local_var = {"wid":16,"dep":8}
-        def replace_logical_ops(expr_str): #replace sv op to py op #others e.g. +/-/*/% py already support
-            expr_str = re.sub(r'&&', ' and ', expr_str)
-            expr_str = re.sub(r'\|\|', ' or ', expr_str)
-            expr_str = re.sub(r'!(?!=)', ' not ', expr_str) # ! can replace != can't replace
-            expr_str = re.sub(r'~', ' not ', expr_str)
-            return expr_str
         if local_vars is None:
             local_vars = self.variables #get var value
         try:
-            expr = re.sub(r'\$\{?(\w+)\}?', lambda m: str(local_vars.get(m.group(1), "0")), expr) #replace ${var} to value 
-            expr = replace_logical_ops(expr) #replace && to and 
-            result = eval(expr, {"__builtins__": __builtins__}, local_vars) #do py op
-            self.log(f"Eval expr: '{expr}' -> {result}")
-            return result
+            code = self.expr_cache.compile(expr) #compile once, reuse the code object
+            lookup = local_vars if local_vars.__class__ is Scope else Scope(None, local_vars) #$var reads
+            result = eval(code, {"__builtins__": __builtins__, VAR_LOOKUP: lookup}, local_vars) #do py op
         except Exception as e:
             error_msg = f"Error evaluating expression '{expr}': {str(e)}"
-            self.log(f"ERROR: {error_msg}")
-            sys.exit(error_msg)
+            if self.tracer:
+                self.tracer.event(self.lineno, self.depth, "error", message=error_msg)
+            raise ExpressionError(error_msg) from e
+        if self.tracer:
+            self.tracer.event(self.lineno, self.depth, "eval", expr=expr, result=result)
+        return result
 
 
     def replace_vars(self, line, local_vars=None):
+        parts = compile_text(line)
+        return line if parts is None else self.substitute(parts, local_vars)
+
+    def substitute(self, parts, local_vars=None): #join the parts of a compiled text line
         if local_vars is None:
-            local_vars = self.variables     
-        def replace_match(match): #for support list index list[x]
-            var_name = match.group(1)
-            indices_str = match.group(2)
+            local_vars = self.variables
+        tracer = self.tracer
+        out = []
+        for part in parts:
+            if part.__class__ is str:
+                out.append(part)
+                continue
+            var_name, indices, text = part
             value = local_vars.get(var_name, "ERROR")
-            if indices_str: #process list[x]
-                indices = re.findall(r'\[([^\]]+)\]', indices_str)
-                for index_expr in indices:
-                    try:
-                        idx = self.eval_expr(index_expr, local_vars)
-                        value = value[idx]
-                        self.log(f"Indexing: ${var_name}{indices_str} -> {value} (at index {idx})")
-                    except Exception as e:
-                        error = f"Error indexing variable {var_name}: {str(e)}"
-                        self.log(f"ERROR: {error}")
-                        return match.group(0)
-            self.log(f"Replace: ${var_name}{indices_str} -> {value}")
-            return str(value)
-        result = re.sub(r'\$\{(\w+)((?:\[[^\]]+\])*)\}', replace_match, line) #replace variable
-        self.log(f"Replace vars: '{line}' -> '{result}'")
-        return result
-   
-
-
+            try:
+                for kind, index in indices: #process list[x]
+                    if kind is INDEX_VAR:
+                        index = expr_value(local_vars.get(index, 0))
+                    elif kind is INDEX_EXPR:
+                        index = self.eval_expr(index, local_vars) #an ExpressionError fails the render
+                    value = value[index]
+            except (IndexError, KeyError, TypeError) as e: #the value can't be indexed, the text stays
+                if tracer:
+                    tracer.event(self.lineno, self.depth, "error", message=f"Error indexing variable {var_name}: {str(e)}")
+                out.append(text)
+                continue
+            if tracer:
+                tracer.event(self.lineno, self.depth, "replace", var=text, value=value)
+            out.append(str(value))
+        return ''.join(out)
 
 
     def process_assignment(self, directive): #get variable 
@@ -233,126 +956,342 @@ class CodeGenerator: #recursion process the line
         if match:
             var_name = match.group(1)
             expr = match.group(2).rstrip(';')
-            try:
-                value = self.eval_expr(expr) #e.g. $width = 2*8 -> value = 16
-            except Exception as e:
-                error_msg = f"Error in assignment '{directive}': {str(e)}"
-                self.log(f"ERROR: {error_msg}")
-                sys.exit(error_msg)
+            value = self.eval_expr(expr) #e.g. $width = 2*8 -> value = 16
             if(var_name == "include"):
-                macro_variable = self.macro_parse.parse_file(expr.strip('"'))
-                print((f"FILE {expr}: GET VARIDABLE {macro_variable}"))
+                macro_variable = self.macro_store.parse_file(self.macro_parse, expr.strip('"'), self.echo)
+                self.dependencies.update(path for path in self.macro_parse.processed_files if path)
+                self.unresolved.update(self.macro_parse.missing)
+                if self.echo:
+                    print((f"FILE {expr}: GET VARIDABLE {macro_variable}"))
                 self.variables.update(macro_variable)
-            self.variables[var_name] = value
-            self.log(f"Assignment: ${var_name} = {value} (type: {type(value).__name__})")
-            self.log(f"Variables now: {self.variables}")
             self.variables[var_name] = value #overwrite local variable
+            if self.tracer:
+                self.tracer.event(self.lineno, self.depth, "assign", var=var_name, value=value,
+                                  type=type(value).__name__, variables=self.variables.flatten())
         else:
             error_msg = f"Error in variable assignment: {directive}"
-            self.log(f"ERROR: {error_msg}")
-            sys.exit(error_msg)
+            if self.tracer:
+                self.tracer.event(self.lineno, self.depth, "error", message=error_msg)
+            raise AssignmentError(error_msg)
+
 
+    def process_lines(self, lines): #parse the lines then run them
+        self.output_lines.extend(self.execute(TemplateParser().parse_lines(lines)))
 
-    def process_lines(self, lines): #process the lines
-        index = 0
-        while index < len(lines):
+    def execute(self, nodes): #walk the parsed block tree, yield the output lines
+        if self.tracer:
+            for node in nodes:
+                self.lineno = node.lineno
+                self.tracer.event(node.lineno, self.depth, "line", source=node.source)
+                yield from node.run(self)
+        else:
+            for node in nodes:
+                yield from node.run(self)
+
+    def stream(self, content): #yield the generated lines one by one, nothing is accumulated
+        if self.tracer:
+            self.tracer.event(0, self.depth, "start", variables=self.variables.flatten())
+        nodes = content if isinstance(content, tuple) else TemplateParser().parse(content) #content or parsed tree
+        if self.memoize and not self.tracer:
+            self.memo = LoopMemo(by_id=block_reads(nodes, assignments=True) is not None)
+        count = 0
+        for line in self.execute(nodes):
+            count += 1
+            yield line
+        if self.tracer:
+            self.tracer.event(self.lineno, self.depth, "done", lines=count,
+                              expr_cache_hits=self.expr_cache.hits, expr_cache_misses=self.expr_cache.misses,
+                              macro_store_hits=self.macro_store.hits, macro_store_misses=self.macro_store.misses,
+                              macro_index_hits=self.macro_store.index_hits)
+
+    def generate(self, content): #generate the code 
+        self.output_lines.extend(self.stream(content))
+        return '\n'.join(self.output_lines)
+
+
+class TemplateParser: #parse the svp lines once into an immutable block tree
+    def parse(self, content):
+        lines = content.split('\n') #get all lines [line0,line1,……]
+        return self.parse_lines(lines)
+
+    def parse_lines(self, lines, start_index=0, end_index=None): #lines[start_index:end_index] -> tuple of nodes
+        if end_index is None:
+            end_index = len(lines)
+        nodes = []
+        index = start_index
+        while index < end_index:
             stripped = lines[index].strip()
-            self.log(f"Processing line {index}: '{stripped}'")
-            if stripped.startswith("//:$"): #process variable assign
-                self.process_assignment(stripped[3:].strip())
+            cmd = stripped[3:].strip() if stripped.startswith("//:") else None
+            if stripped.startswith("//:$"): #variable assign
+                nodes.append(Assignment(index + 1, stripped[3:].strip()))
                 index += 1
-                continue
-            if stripped.startswith("//:") and stripped[3:].strip().startswith("for("): #process for 
-                self.log("Found FOR block")
-                for_block = ForBlock() #process for block
-                index, for_code = for_block.parse(self, lines, index)
-                self.output_lines.extend(for_code) #[1,2,3].extend [4,5,6] to [1,2,3,4,5,6]
-                self.log(f"FOR block processed, added {len(for_code)} lines")
-                continue
-            if stripped.startswith("//:") and (stripped[3:].strip().startswith("if(") or 
-                                             stripped[3:].strip().startswith("elsif(") or 
-                                             stripped[3:].strip().startswith("else")):
-                self.log("Found IF/ELSIF/ELSE block")
-                if_block = IfBlock() #process if/elsif/else
-                index, if_code = if_block.parse(self, lines, index)
-                self.output_lines.extend(if_code)
-                self.log(f"IF block processed, added {len(if_code)} lines")
-                continue
-            if stripped == "//:}": #end of a block
+            elif cmd is not None and cmd.startswith("for("): #for block
+                index, node = ForBlock.parse(self, lines, index, end_index)
+                nodes.append(node)
+            elif cmd is not None and (cmd.startswith("if(") or cmd.startswith("elsif(") or cmd.startswith("else")):
+                index, node = IfBlock.parse(self, lines, index, end_index)
+                nodes.append(node)
+            else:
+                if cmd is None: #normal string, "//:}" and other directive are dropped
+                    nodes.append(TextLine(index + 1, lines[index]))
                 index += 1
-                continue
-            if not stripped.startswith("//:"): #normal string
-                processed_line = self.replace_vars(lines[index])
-                self.output_lines.append(processed_line) #[1,2,3].append [4,5,6] to [1,2,3,[4,5,6]]
-                self.log(f"Added output line: '{processed_line}'")
-            index += 1
-    
-    def generate(self, content): #generate the code 
-        lines = content.split('\n') #get all lines [line0,line1,……]
-        self.log("Starting code generation")
-        self.log(f"Initial variables: {self.variables}")
-        self.process_lines(lines)
-        self.log("Code generation completed")
-        return '\n'.join(self.output_lines)
+        return tuple(nodes)
+
+
+class TextLine: #normal code line
+    __slots__ = ("lineno", "text", "parts")
+
+    def __init__(self, lineno, text):
+        self.lineno = lineno
+        self.text = text
+        self.parts = compile_text(text) #None when there is no ${var}
+
+    @property
+    def source(self):
+        return self.text.strip()
+
+    def run(self, generator):
+        processed_line = self.text if self.parts is None else generator.substitute(self.parts)
+        if generator.tracer:
+            generator.tracer.event(self.lineno, generator.depth, "output", line=processed_line)
+        return (processed_line,)
+
+
+class Assignment: #//:$var = expr
+    __slots__ = ("lineno", "directive")
+
+    def __init__(self, lineno, directive):
+        self.lineno = lineno
+        self.directive = directive
+
+    @property
+    def source(self):
+        return "//:" + self.directive
+
+    def run(self, generator):
+        generator.process_assignment(self.directive)
+        return ()
+
+
+COUNTED_OPS = {ast.Lt: "<", ast.LtE: "<=", ast.Gt: ">", ast.GtE: ">="}
+
+def _is_var_ref(node, name): #$name (rewritten lookup) or bare name in a parsed expression
+    if isinstance(node, ast.Name):
+        return node.id == name
+    return (isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute)
+            and isinstance(node.func.value, ast.Name) and node.func.value.id == VAR_LOOKUP
+            and bool(node.args) and isinstance(node.args[0], ast.Constant) and node.args[0].value == name)
+
+def _uses_var(node, name):
+    return any(_is_var_ref(child, name) for child in ast.walk(node))
+
+
+PURE_CALLS = {"len", "int", "str", "bool", "float", "abs", "min", "max", "sum", "round", "pow", "divmod",
+              "hex", "bin", "oct", "ord", "chr", "range", "tuple", "list", "sorted", "reversed", "any", "all"}
+
+@functools.lru_cache(maxsize=4096)
+def expr_reads(expr): #names an expression reads, None if it may have a side effect
+    try:
+        tree = ast.parse(ExprCache.rewrite(expr), mode="eval")
+    except SyntaxError:
+        return None
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Call):
+            func = node.func
+            if (isinstance(func, ast.Attribute) and isinstance(func.value, ast.Name) and func.value.id == VAR_LOOKUP
+                    and node.args and isinstance(node.args[0], ast.Constant)):
+                names.add(node.args[0].value)
+            elif not (isinstance(func, ast.Name) and func.id in PURE_CALLS):
+                return None #method calls and unknown functions may mutate or print
+        elif isinstance(node, (ast.NamedExpr, ast.Lambda, ast.Yield, ast.YieldFrom, ast.Await)):
+            return None
+        elif isinstance(node, ast.Name) and node.id != VAR_LOOKUP:
+            names.add(node.id)
+    return frozenset(names)
+
+def block_reads(nodes, assignments=False): #names a block tree reads, None if it assigns or has a side effect
+    names = set()
+    for node in nodes:
+        exprs = ()
+        if isinstance(node, TextLine):
+            for part in node.parts or ():
+                if part.__class__ is str:
+                    continue
+                names.add(part[0])
+                for kind, index in part[1]:
+                    if kind is INDEX_VAR:
+                        names.add(index)
+                    elif kind is INDEX_EXPR:
+                        exprs += (index,)
+        elif isinstance(node, Assignment):
+            match = re.match(r'\$(\w+)\s*=\s*(.+?)(;?)$', node.directive)
+            if not assignments or not match:
+                return None
+            exprs = (match.group(2).rstrip(';'),)
+        elif isinstance(node, ForBlock):
+            step = re.match(r'^\$?(\w+)\s*=\s*(.+)$', node.step_expr)
+            exprs = (node.init_expr, node.cond_expr, step.group(2) if step else node.step_expr)
+            body = block_reads(node.body, assignments) if assignments else node.reads
+            if body is None:
+                return None
+            names.update(body)
+        elif isinstance(node, IfBlock):
+            for condition, body in node.branches:
+                exprs += (condition,)
+                body = block_reads(body, assignments)
+                if body is None:
+                    return None
+                names.update(body)
+        for expr in exprs:
+            reads = expr_reads(expr)
+            if reads is None:
+                return None
+            names.update(reads)
+    return tuple(sorted(names))
 
 
 class ForBlock: #for block process
-    def parse(self, parent_generator, lines, start_index): #parse for block return line num and generate code
+    __slots__ = ("lineno", "source", "var_name", "init_expr", "cond_expr", "step_expr", "body", "counted", "reads")
+
+    def __init__(self, lineno, source, var_name, init_expr, cond_expr, step_expr, body):
+        self.lineno = lineno
+        self.source = source
+        self.var_name = var_name #i
+        self.init_expr = init_expr #0
+        self.cond_expr = cond_expr #$i<xxx
+        self.step_expr = step_expr #$i=$i+1
+        self.body = body #tuple of nodes
+        self.counted = self.counted_form(var_name, cond_expr, step_expr) #(op, bound, delta) or None
+        self.reads = block_reads(body) #variables the body output depends on, None if it writes any
+
+    @staticmethod
+    def counted_form(var_name, cond_expr, step_expr): #$i<B; $i=$i+K with B and K not using $i
+        step_match = re.match(r'^\$?(\w+)\s*=\s*(.+)$', step_expr)
+        if not step_match or step_match.group(1) != var_name:
+            return None
+        try:
+            cond = ast.parse(ExprCache.rewrite(cond_expr), mode="eval").body
+            step = ast.parse(ExprCache.rewrite(step_match.group(2)), mode="eval").body
+        except SyntaxError:
+            return None
+        if not (isinstance(cond, ast.Compare) and len(cond.ops) == 1 and type(cond.ops[0]) in COUNTED_OPS
+                and _is_var_ref(cond.left, var_name) and not _uses_var(cond.comparators[0], var_name)):
+            return None
+        if not (isinstance(step, ast.BinOp) and isinstance(step.op, (ast.Add, ast.Sub))):
+            return None
+        if _is_var_ref(step.left, var_name) and not _uses_var(step.right, var_name):
+            delta = ast.unparse(step.right)
+            if isinstance(step.op, ast.Sub):
+                delta = f"-({delta})"
+        elif isinstance(step.op, ast.Add) and _is_var_ref(step.right, var_name) and not _uses_var(step.left, var_name):
+            delta = ast.unparse(step.left)
+        else:
+            return None
+        return COUNTED_OPS[type(cond.ops[0])], ast.unparse(cond.comparators[0]), delta
+
+    @classmethod
+    def parse(cls, parser, lines, start_index, end_index): #parse for block return next line num and the node
         cmd = lines[start_index].strip()[3:].strip()
         match = re.match(r'for\(\s*\$(\w+)\s*=\s*([^;]+);\s*([^;]+);\s*([^)]+)\)\s*\{', cmd) #get for control parameters
         if not match:
-            error_msg = f"Invalid for loop cmd: {cmd}"
-            parent_generator.log(f"ERROR: {error_msg}")
-            raise ValueError(error_msg)
-        
-        var_name = match.group(1) #i
-        init_expr = match.group(2).strip() #0
-        cond_expr = match.group(3).strip() #$i<xxx
-        step_expr = self.normalize_step_expr(match.group(4).strip()) #$i=$i+1
-        parent_generator.log(f"FOR loop: ${var_name} = {init_expr}; {cond_expr}; {step_expr}")
-        generator = CodeGenerator(parent_vars=parent_generator.variables,
-                                  debug=parent_generator.debug) #child generator,variable from parent generator
-        generator.debug_log = parent_generator.debug_log
-        generator.debug_tab = parent_generator.debug_tab + 1
-        generator.variables[var_name] = generator.eval_expr(init_expr) #for(i=0;i<10;i++) get i=0 value
-        generator.log(f"Initialized loop variable ${var_name} = {generator.variables[var_name]}")
+            raise TemplateSyntaxError(f"Invalid for loop cmd: {cmd}")
         index = start_index + 1 #for block first line
         depth = 1  #nest depth
-        body_lines = []
-        
-        while index < len(lines) and depth > 0:
+        while index < end_index:
             stripped = lines[index].strip()
             if stripped.endswith('{') and stripped.startswith('//:'): #for block inner has other if/for blk
                 depth += 1
             if stripped == "//:}":  #a block has end (maybe inner or outside)
                 depth -= 1
                 if depth == 0: #the outside block has end 
-                    index += 1
                     break
-            body_lines.append(lines[index]) #get the for block all info(include inner nested block)
             index += 1
-        output = []
+        body = parser.parse_lines(lines, start_index + 1, index) #the for block all info(include inner nested block)
+        if index < end_index: #skip the close "//:}"
+            index += 1
+        node = cls(start_index + 1, lines[start_index].strip(), match.group(1),
+                   match.group(2).strip(), match.group(3).strip(),
+                   cls.normalize_step_expr(match.group(4).strip()), body)
+        return index, node
+
+    def run(self, parent_generator): #generate code of the for block
+        var_name = self.var_name
+        cond_expr = self.cond_expr
+        tracer = parent_generator.tracer
+        generator = parent_generator.child(parent_generator.variables) #loop variable is written to the parent scope
+        generator.variables[var_name] = generator.eval_expr(self.init_expr) #for(i=0;i<10;i++) get i=0 value
+        if tracer:
+            tracer.event(self.lineno, generator.depth, "for", var=var_name, init=generator.variables[var_name],
+                         cond=cond_expr, step=self.step_expr)
+        if self.counted is not None: #try the native integer range first
+            values = self.counted_range(generator)
+            if values is not None:
+                scope = generator.variables
+                for loop_cnt, value in enumerate(values, 1):
+                    scope[var_name] = value
+                    if tracer:
+                        tracer.event(self.lineno, generator.depth, "iteration", count=loop_cnt,
+                                     variables=generator.variables.flatten())
+                    yield from self.body_lines(generator)
+                scope[var_name] = values.start + values.step * len(values) #first value failing the condition
+                if tracer:
+                    tracer.event(self.lineno, generator.depth, "end-for", iterations=len(values),
+                                 variables=generator.variables.flatten())
+                return
         loop_cnt = 0
         while generator.eval_expr(cond_expr): #process for body block (if meet i<xxx)
             loop_cnt += 1
-            generator.log(f"Loop iteration #{loop_cnt}, condition '{cond_expr}' is True")
-            generator.log(f"Loop variables: {generator.variables}")
-            body_generator = CodeGenerator(parent_vars=generator.variables,
-                                          debug=parent_generator.debug)
-            body_generator.debug_log = parent_generator.debug_log 
-            body_generator.debug_tab = generator.debug_tab + 1
-            body_generator.process_lines(body_lines) #maybe for inner has for block 
-            output.extend(body_generator.output_lines)
-            generator.log(f"Body generated {len(body_generator.output_lines)} lines")
-            self.step(generator, var_name, step_expr) #process i=i+1
-            generator.log(f"After step: ${var_name} = {generator.variables[var_name]}")
-        generator.log(f"FOR loop completed after {loop_cnt} iterations")
-        generator.log(f"Final loop variables: {generator.variables}")
-        parent_generator.variables.update(generator.variables) #child gen ok and get parent variable
-        parent_generator.debug_tab = parent_generator.debug_tab -1 
-        return index, output
-    
-    def normalize_step_expr(self, expr): #for change i++ i+=1 into i=i+1
+            if loop_cnt > generator.max_iterations:
+                self.too_many_iterations(generator)
+            if tracer:
+                tracer.event(self.lineno, generator.depth, "iteration", count=loop_cnt,
+                             variables=generator.variables.flatten())
+            yield from self.body_lines(generator) #maybe for inner has for block 
+            generator.lineno = self.lineno
+            self.step(generator, var_name, self.step_expr) #process i=i+1
+        if tracer:
+            tracer.event(self.lineno, generator.depth, "end-for", iterations=loop_cnt,
+                         variables=generator.variables.flatten())
+
+    def body_lines(self, generator): #one iteration, reused from an earlier one that read the same values
+        if generator.memo is None or self.reads is None:
+            return generator.child(generator.variables.child()).execute(self.body) #body writes stay in the iteration
+        return generator.memo.lines(self, generator)
+
+    def counted_range(self, generator): #range of the loop values, None if it needs the general path
+        op, bound_expr, delta_expr = self.counted
+        start = generator.variables[self.var_name]
+        generator.lineno = self.lineno
+        bound = generator.eval_expr(bound_expr) #loop invariant, evaluated once
+        delta = generator.eval_expr(delta_expr)
+        values = self.counted_values(op, start, bound, delta)
+        if values is not None and len(values) > generator.max_iterations:
+            self.too_many_iterations(generator)
+        return values
+
+    @staticmethod
+    def counted_values(op, start, bound, delta): #range for int operands, None otherwise
+        if type(start) is not int or type(bound) is not int or type(delta) is not int:
+            return None
+        if op in ("<", "<=") and delta > 0:
+            return range(start, bound + 1 if op == "<=" else bound, delta)
+        if op in (">", ">=") and delta < 0:
+            return range(start, bound - 1 if op == ">=" else bound, delta)
+        return None #no progress or wrong direction, let the general path decide
+
+    @staticmethod
+    def iteration_error(lineno, source, max_iterations):
+        return f"Error: for loop at line {lineno} exceeds {max_iterations} iterations: {source}"
+
+    def too_many_iterations(self, generator):
+        error_msg = self.iteration_error(self.lineno, self.source, generator.max_iterations)
+        if generator.tracer:
+            generator.tracer.event(self.lineno, generator.depth, "error", message=error_msg)
+        raise LoopLimitError(error_msg)
+
+    @staticmethod
+    def normalize_step_expr(expr): #for change i++ i+=1 into i=i+1
         if re.match(r'^\$?(\w+)\+\+$', expr): #support i++/i--
             return f"{expr.replace('++', '')} = {expr.replace('++', '')} + 1" #i++ to i=i+1
         if re.match(r'^\$?(\w+)--$', expr):
@@ -374,145 +1313,1136 @@ class ForBlock: #for block process
 
 
 class IfBlock:
-    def parse(self, parent_generator, lines, start_index): #process(if/elsif/else)
+    __slots__ = ("lineno", "source", "branches")
+
+    def __init__(self, lineno, source, branches):
+        self.lineno = lineno
+        self.source = source
+        self.branches = branches #tuple of (condition, nodes)
+
+    @classmethod
+    def parse(cls, parser, lines, start_index, end_index): #parse(if/elsif/else) return next line num and the node
         branches = []
         current_branch = None
         index = start_index
-        parent_generator.log("Processing IF block")
         depth = 1  #nest depth
-        while index < len(lines):
+        while index < end_index:
             stripped = lines[index].strip()
             cmd = stripped[3:].strip() if stripped.startswith("//:") else ""
             if current_branch is not None:
                 if cmd.startswith("if(") or cmd.startswith("for("):
-                    current_branch["lines"].append(lines[index]) #new nest block
-                    depth += 1
+                    depth += 1 #new nest block
                     index += 1
                 elif cmd.startswith("elsif(") or cmd.startswith("else"):
                     if(depth == 1):
-                        branches.append(current_branch) #one condition ok
+                        branches.append(current_branch + [index]) #one condition ok
                         if(cmd.startswith("elsif(")): #generate new elsif condition
                             match = re.match(r'elsif\((.+)\)\s*\{', cmd)
                             if not match:
-                                error_msg = f"Invalid elsif directive: {cmd}"
-                                parent_generator.log(f"ERROR: {error_msg}")
-                                raise ValueError(error_msg)
-                            condition = match.group(1).strip()
-                            current_branch = {"condition": condition, "lines": []}
-                            parent_generator.log(f"ELSIF condition: {condition}")                            
+                                raise TemplateSyntaxError(f"Invalid elsif directive: {cmd}")
+                            current_branch = [match.group(1).strip(), index + 1]
                         else : #generate new else condition
-                            current_branch = {"condition": "True", "lines": []}
-                            parent_generator.log("ELSE branch")
+                            current_branch = ["True", index + 1]
                         index += 1 #mov to next lane to collect info                         
-                    else : #nested block just append
-                        current_branch["lines"].append(lines[index]) #append normal lane
+                    else : #nested block
                         depth += 1
                         index += 1
                 elif stripped == "//:}":
                     depth -= 1
                     if(depth == 0): #parent block is ok
+                        branches.append(current_branch + [index])
                         index += 1
-                        branches.append(current_branch)
                         break
-                    else : #nested block just append
-                        current_branch["lines"].append(lines[index])
+                    else : #nested block
                         index += 1
                 else : #normal lane
-                    current_branch["lines"].append(lines[index])
                     index += 1
             else:
                 if cmd.startswith("if(") or cmd.startswith("elsif(") or cmd.startswith("else"):
                     if(cmd.startswith("elsif(") or cmd.startswith("else")) : #can't elsif else begin 
-                        error_msg = f"Error in variable assignment: {lines[index]}"
-                        parent_generator.log(f"ERROR: {error_msg}")
-                        sys.exit(error_msg)
+                        raise TemplateSyntaxError(f"Error in variable assignment: {lines[index]}")
                     else: #if branch
                         match = re.match(r'if\((.+)\)\s*\{', cmd)
                         if not match:
-                            error_msg = f"Invalid if directive: {cmd}"
-                            parent_generator.log(f"ERROR: {error_msg}")
-                            raise ValueError(error_msg)
-                        condition = match.group(1).strip()
-                        current_branch = {"condition": condition, "lines": [],"done":0,"type":"IF"}
-                        parent_generator.log(f"IF condition: {condition}")            
+                            raise TemplateSyntaxError(f"Invalid if directive: {cmd}")
+                        current_branch = [match.group(1).strip(), index + 1] #[condition, first line]
                     index += 1 #mov to next lane to collect info 
                     continue
                 else:
-                    error_msg = f"Error in variable assignment: {lines[index]}"
-                    parent_generator.log(f"ERROR: {error_msg}")
-                    sys.exit(error_msg)
-        #process branch 
-        generator = CodeGenerator(parent_vars=parent_generator.variables,
-                                  debug=parent_generator.debug)
-        generator.debug_log = parent_generator.debug_log
-        generator.debug_tab = parent_generator.debug_tab + 1
-        executed = False
-        output = []
-        for branch in branches:
-            if not executed:
-                condition = branch["condition"]
-                condition_result = generator.eval_expr(condition)
-                generator.log(f"Evaluating condition: {condition} -> {condition_result}")
-                if condition_result:
-                    executed = True
-                    generator.log("Condition is True, executing branch")
-                    body_generator = CodeGenerator(parent_vars=generator.variables,
-                                                  debug=parent_generator.debug)
-                    body_generator.debug_log = parent_generator.debug_log
-                    body_generator.debug_tab = generator.debug_tab + 1
-                    body_generator.process_lines(branch["lines"])
-                    output.extend(body_generator.output_lines)
-                    generator.log(f"Branch generated {len(body_generator.output_lines)} lines")
-                    generator.variables.update(body_generator.variables)
-                else:
-                    generator.log("Condition is False, skipping branch")
+                    raise TemplateSyntaxError(f"Error in variable assignment: {lines[index]}")
+        branches = tuple((condition, parser.parse_lines(lines, begin, end)) for condition, begin, end in branches)
+        return index, cls(start_index + 1, lines[start_index].strip(), branches)
+
+    def run(self, parent_generator): #generate code of the taken branch
+        tracer = parent_generator.tracer
+        generator = parent_generator.child(parent_generator.variables) #branch writes go to the parent scope
+        for condition, body in self.branches:
+            generator.lineno = self.lineno
+            condition_result = generator.eval_expr(condition)
+            if tracer:
+                tracer.event(self.lineno, generator.depth, "branch", cond=condition, taken=bool(condition_result))
+            if condition_result: #the first true branch, skip the others
+                body_generator = generator.child(generator.variables)
+                yield from body_generator.execute(body)
+                break
+        if tracer:
+            tracer.event(self.lineno, generator.depth, "end-if")
+
+
+
+class _ScopeNames(ast.NodeTransformer): #names of a rewritten expression read straight from the scope variable
+    def __init__(self, scope, reserved):
+        self.scope = scope
+        self.reserved = reserved #locals of render(), a builtin of the same name would be shadowed
+
+    def visit_Name(self, node):
+        if node.id == VAR_LOOKUP: #$x
+            return ast.copy_location(ast.Name(self.scope, ast.Load()), node)
+        if hasattr(builtins, node.id) and node.id not in self.reserved: #variable first, then the builtin
+            call = f"{self.scope}.get({node.id!r}, {node.id})"
+        else:
+            call = f"name({self.scope}, {node.id!r})"
+        return ast.copy_location(ast.parse(call, mode="eval").body, node)
+
+
+class TemplateCompiler: #parsed block tree -> python source of render(g, s0, rt), a generator of the output lines
+    UNSUPPORTED = (ast.Lambda, ast.ListComp, ast.SetComp, ast.DictComp, ast.GeneratorExp, ast.NamedExpr,
+                   ast.Await, ast.Yield, ast.YieldFrom) #expressions with their own scope stay on eval_expr
+    RESERVED = {"g", "rt", "Scope", "name", "counted", "loop", "texts", "evaluate", "substitute"}
+
+    def __init__(self):
+        self.lines = []
+        self.exprs = {} #source line -> template expression, for the error message
+        self.texts = [] #text lines with list indices, substituted by the generator
+        self.count = 0
+
+    def emit(self, indent, code, expr=None):
+        self.lines.append("    " * indent + code)
+        if expr is not None:
+            self.exprs[len(self.lines)] = expr
+
+    def compile(self, nodes, name="<svp>"):
+        self.emit(0, f"#generated by expand_gen.py from {name!r}")
+        self.emit(0, "def render(g, s0, rt):")
+        self.emit(1, "Scope, name, counted, loop, texts = rt.Scope, rt.name, rt.counted, rt.loop, rt.texts")
+        self.emit(1, "evaluate, substitute = g.eval_expr, g.substitute")
+        self.emit(1, "yield from ()")
+        self.block(nodes, 1, "s0", "g")
+        self.emit(0, f"TEXTS = {tuple(self.texts)!r}")
+        self.emit(0, f"EXPRS = {self.exprs!r}")
+        return "\n".join(self.lines) + "\n"
+
+    def expression(self, expr, scope): #python code of a template expression reading the given scope
+        try:
+            tree = ast.parse(ExprCache.source(expr), mode="eval")
+        except SyntaxError:
+            tree = None
+        if tree is None or any(isinstance(node, self.UNSUPPORTED) for node in ast.walk(tree)):
+            return f"evaluate({expr!r}, {scope})" #same error as the interpreter
+        return ast.unparse(_ScopeNames(scope, self.RESERVED | {scope}).visit(tree))
+
+    def block(self, nodes, indent, scope, generator): #generator None: a fresh one per block run, made on demand
+        start = len(self.lines)
+        lazy = generator is None
+        if lazy and any(isinstance(node, Assignment) and self.assignment(node) is None for node in nodes):
+            self.count += 1
+            generator = f"g{self.count}"
+            self.emit(indent, f"{generator} = None")
+        for node in nodes:
+            if isinstance(node, TextLine):
+                self.text_line(node, indent, scope)
+            elif isinstance(node, Assignment):
+                target = self.assignment(node)
+                if target is not None:
+                    var_name, expr = target
+                    self.emit(indent, f"{scope}.vars[{var_name!r}] = {self.expression(expr, scope)}", expr)
+                else: #$include and bad directives go through the generator
+                    if lazy:
+                        self.emit(indent, f"if {generator} is None: {generator} = g.child({scope})")
+                    self.emit(indent, f"{generator}.process_assignment({node.directive!r})")
+            elif isinstance(node, ForBlock):
+                self.for_block(node, indent, scope)
+            elif isinstance(node, IfBlock):
+                self.if_block(node, indent, scope)
+        if len(self.lines) == start:
+            self.emit(indent, "pass")
+
+    @staticmethod
+    def assignment(node): #(var, expr) of a plain assignment, None for the generator path
+        match = re.match(r'\$(\w+)\s*=\s*(.+?)(;?)$', node.directive)
+        if not match or match.group(1) == "include":
+            return None
+        return match.group(1), match.group(2).rstrip(';')
+
+    def text_line(self, node, indent, scope):
+        if node.parts is None:
+            self.emit(indent, f"yield {node.text!r}")
+            return
+        if any(part.__class__ is not str and part[1] for part in node.parts): #list index, keep the error fallback
+            self.texts.append(node.text)
+            self.emit(indent, f"yield substitute(texts[{len(self.texts) - 1}], {scope})")
+            return
+        pieces = [repr(part) if part.__class__ is str else f"str({scope}.get({part[0]!r}, 'ERROR'))"
+                  for part in node.parts]
+        self.emit(indent, f"yield {' + '.join(pieces)}")
+
+    def for_block(self, node, indent, scope):
+        self.count += 1
+        n = self.count
+        var_name = node.var_name
+        self.emit(indent, f"{scope}.vars[{var_name!r}] = {self.expression(node.init_expr, scope)}", node.init_expr)
+        if node.counted is not None:
+            op, bound_expr, delta_expr = node.counted
+            self.emit(indent, f"b{n} = {self.expression(bound_expr, scope)}", bound_expr)
+            self.emit(indent, f"d{n} = {self.expression(delta_expr, scope)}", delta_expr)
+            self.emit(indent, f"r{n} = counted({op!r}, {scope}.vars[{var_name!r}], b{n}, d{n}, g, "
+                              f"{node.lineno}, {node.source!r})")
+        else:
+            self.emit(indent, f"r{n} = None")
+        match = re.match(r'^\$?(\w+)\s*=\s*(.+)$', node.step_expr)
+        step_var, step_expr = (match.group(1), match.group(2)) if match else (var_name, node.step_expr)
+        self.emit(indent, f"c{n} = lambda {scope}: {self.expression(node.cond_expr, scope)}", node.cond_expr)
+        self.emit(indent, f"t{n} = lambda {scope}: {self.expression(step_expr, scope)}", step_expr)
+        self.emit(indent, f"for v{n} in (r{n} if r{n} is not None else "
+                          f"loop(g, {scope}, {var_name!r}, c{n}, {step_var!r}, t{n}, {node.lineno}, {node.source!r})):")
+        self.emit(indent + 1, f"{scope}.vars[{var_name!r}] = v{n}")
+        self.emit(indent + 1, f"s{n} = Scope({scope})") #body writes stay in the iteration
+        self.block(node.body, indent + 1, f"s{n}", None)
+        self.emit(indent, f"if r{n} is not None:")
+        self.emit(indent + 1, f"{scope}.vars[{var_name!r}] = r{n}.start + r{n}.step * len(r{n})")
+
+    def if_block(self, node, indent, scope):
+        for index, (condition, body) in enumerate(node.branches):
+            keyword = "if" if index == 0 else "elif"
+            self.emit(indent, f"{keyword} {self.expression(condition, scope)}:", condition)
+            self.block(body, indent + 1, scope, None) #branch writes go to the parent scope
+
+
+class CompiledTemplate: #render() of a TemplateCompiler module and the helpers it calls
+    Scope = Scope
+
+    def __init__(self, code):
+        namespace = {"__builtins__": builtins}
+        exec(code, namespace)
+        self.filename = code.co_filename
+        self.render = namespace["render"]
+        self.exprs = namespace["EXPRS"]
+        self.texts = tuple(compile_text(text) for text in namespace["TEXTS"])
+
+    def stream(self, generator): #output lines of the template run on the generator's scope
+        try:
+            yield from self.render(generator, generator.variables, self)
+        except ExpandError:
+            raise
+        except Exception as e: #map the failing source line back to the template expression
+            import traceback
+            lineno = None
+            for frame, frame_lineno in traceback.walk_tb(e.__traceback__):
+                if frame.f_code.co_filename == self.filename:
+                    lineno = frame_lineno
+            if lineno not in self.exprs:
+                raise
+            raise ExpressionError(f"Error evaluating expression '{self.exprs[lineno]}': {str(e)}") from e
+
+    @staticmethod
+    def name(scope, name): #bare name of an expression, the variable else the builtin
+        try:
+            return scope[name]
+        except KeyError:
+            pass
+        try:
+            return getattr(builtins, name)
+        except AttributeError:
+            raise NameError(f"name '{name}' is not defined") from None
+
+    @staticmethod
+    def counted(op, start, bound, delta, generator, lineno, source):
+        values = ForBlock.counted_values(op, start, bound, delta)
+        if values is not None and len(values) > generator.max_iterations:
+            raise LoopLimitError(ForBlock.iteration_error(lineno, source, generator.max_iterations))
+        return values
+
+    @staticmethod
+    def loop(generator, scope, var_name, cond, step_var, step, lineno, source): #values of a general for loop
+        count = 0
+        while cond(scope):
+            count += 1
+            if count > generator.max_iterations:
+                raise LoopLimitError(ForBlock.iteration_error(lineno, source, generator.max_iterations))
+            yield scope.vars[var_name]
+            scope.vars[step_var] = step(scope)
+
+
+COMPILED_SUFFIX = ".svpc"
+
+@functools.lru_cache(maxsize=None)
+def _engine_hash(): #a new expand_gen.py invalidates every cached output and compiled template
+    return _file_hash(os.path.abspath(__file__))
+
+def load_compiled(input_path, content, nodes=None): #CompiledTemplate cached in __pycache__ next to the template, None if it can't compile
+    digest = hashlib.sha256()
+    for part in (_engine_hash(), sys.implementation.cache_tag or "", content):
+        digest.update(part.encode())
+    cache_dir = os.path.join(os.path.dirname(os.path.abspath(input_path)), "__pycache__")
+    base = os.path.basename(input_path)
+    cache_path = os.path.join(cache_dir, f"{base}.{digest.hexdigest()[:16]}{COMPILED_SUFFIX}")
+    code = None
+    try:
+        with open(cache_path, 'rb') as file:
+            code = marshal.load(file)
+    except (OSError, EOFError, ValueError, TypeError):
+        pass
+    if not isinstance(code, types.CodeType):
+        if nodes is None:
+            nodes = TemplateParser().parse(content)
+        try:
+            code = compile(TemplateCompiler().compile(nodes, input_path), f"<svp {input_path}>", "exec")
+        except (SyntaxError, RecursionError, MemoryError) as e: #e.g. too deeply nested for python
+            print(f"Note: {input_path} can't be compiled ({e}), using the interpreter")
+            return None
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            for stale in os.listdir(cache_dir): #older versions of the same template
+                if stale.startswith(base + ".") and stale.endswith(COMPILED_SUFFIX):
+                    with contextlib.suppress(OSError):
+                        os.remove(os.path.join(cache_dir, stale))
+            tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'wb') as file:
+                marshal.dump(code, file)
+            os.replace(tmp_path, cache_path)
+        except OSError: #read-only tree, just don't cache
+            pass
+    return CompiledTemplate(code)
+
+def check_engines(reference, compiled, input_path, echo=True): #reference lines, exit at the first line the compiled engine differs
+    count = 0 #compiled comes from a generator without echo, the console shows the reference run once
+    for count, (expected, actual) in enumerate(itertools.zip_longest(reference, compiled), 1):
+        if expected != actual:
+            raise EngineMismatchError(f"Engine mismatch in {input_path} at output line {count}: "
+                     f"interpreter {expected!r}, compiled {actual!r}")
+        yield expected
+    if echo:
+        print(f"Engines match: {count} lines")
+
+
+class LineStats: #profile of one template line
+    __slots__ = ("lineno", "source", "count", "cumulative", "self_time", "eval_time", "subst_time", "lines")
+
+    def __init__(self, lineno, source):
+        self.lineno = lineno
+        self.source = source
+        self.count = 0
+        self.cumulative = 0.0
+        self.self_time = 0.0 #excluding eval_expr/replace_vars and nested lines
+        self.eval_time = 0.0
+        self.subst_time = 0.0
+        self.lines = 0 #output lines produced, nested lines included
+
+
+class Profiler: #time spent per template line, time waiting for the output consumer is not counted
+    def __init__(self):
+        self.stats = {}
+        self.collapsed = collections.defaultdict(float) #stack of frames -> self time
+        self.stack = [] #[kind, stats, path, enter time, paused total at enter]
+        self.clock = time.perf_counter
+        self.last = self.clock()
+        self.paused = False
+        self.pause_start = 0.0
+        self.paused_total = 0.0
+
+    def _charge(self, now): #time since the last event goes to the frame on top
+        if self.stack:
+            kind, stats, path, _, _ = self.stack[-1]
+            elapsed = now - self.last
+            if kind == "line":
+                stats.self_time += elapsed
+            elif kind == "eval":
+                stats.eval_time += elapsed
             else:
-                generator.log("Skipping branch (previous condition was true)")
-        
-        if not executed:
-            generator.log("No branch executed in IF block")
-        parent_generator.variables.update(generator.variables)
-        parent_generator.debug_tab = generator.debug_tab - 1
-        return index, output
+                stats.subst_time += elapsed
+            self.collapsed[path] += elapsed
+        self.last = now
+
+    def enter(self, node):
+        now = self.clock()
+        self._charge(now)
+        stats = self.stats.get(node.lineno)
+        if stats is None:
+            stats = self.stats[node.lineno] = LineStats(node.lineno, node.source)
+        stats.count += 1
+        label = f"L{node.lineno} {node.source}".replace(";", ",")
+        path = self.stack[-1][2] + (label,) if self.stack else (label,)
+        self.stack.append(["line", stats, path, now, self.paused_total])
+
+    def exit(self):
+        now = self.clock()
+        self._charge(now)
+        _, stats, _, start, paused = self.stack.pop()
+        stats.cumulative += now - start - (self.paused_total - paused)
 
+    def call(self, kind): #eval_expr/replace_vars of the current line
+        now = self.clock()
+        self._charge(now)
+        if self.stack:
+            top = self.stack[-1]
+            self.stack.append([kind, top[1], top[2] + (f"{kind}_expr" if kind == "eval" else "replace_vars",),
+                               now, self.paused_total])
 
+    def ret(self):
+        if self.stack:
+            self._charge(self.clock())
+            self.stack.pop()
+
+    def output(self): #a line leaves the generator, stop the clock until it is asked for the next one
+        if not self.paused:
+            now = self.clock()
+            self._charge(now)
+            for frame in self.stack:
+                if frame[0] == "line":
+                    frame[1].lines += 1
+            self.paused = True
+            self.pause_start = now
+
+    def resume(self):
+        if self.paused:
+            now = self.clock()
+            self.paused = False
+            self.paused_total += now - self.pause_start
+            self.last = now
+
+    def report(self): #text table, the most expensive lines first
+        rows = sorted(self.stats.values(), key=lambda s: s.self_time + s.eval_time + s.subst_time, reverse=True)
+        table = [f"{'line':>6} {'count':>9} {'cum(s)':>10} {'self(s)':>10} {'eval(s)':>10} {'subst(s)':>10} "
+                 f"{'lines':>9}  source"]
+        for s in rows:
+            table.append(f"{s.lineno:>6} {s.count:>9} {s.cumulative:>10.4f} {s.self_time:>10.4f} "
+                         f"{s.eval_time:>10.4f} {s.subst_time:>10.4f} {s.lines:>9}  {s.source}")
+        return "\n".join(table)
+
+    def collapsed_stacks(self): #flamegraph.pl input, values in microseconds
+        lines = []
+        for path, elapsed in sorted(self.collapsed.items()):
+            micros = int(round(elapsed * 1e6))
+            if micros:
+                lines.append(f"{';'.join(path)} {micros}")
+        return "\n".join(lines)
 
-def process_file(input_path, output_path, global_vars=None, debug=False):#progress the file
+
+class ProfilingCodeGenerator(CodeGenerator): #CodeGenerator feeding a Profiler, used by --profile
+    memoize = False #every line is charged where it runs
+    def __init__(self, *args, profiler=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.profiler = profiler
+
+    def child(self, scope):
+        generator = super().child(scope)
+        generator.profiler = self.profiler
+        return generator
+
+    def execute(self, nodes):
+        profiler = self.profiler
+        for node in nodes:
+            self.lineno = node.lineno
+            if self.tracer:
+                self.tracer.event(node.lineno, self.depth, "line", source=node.source)
+            profiler.enter(node)
+            for line in node.run(self):
+                profiler.output()
+                yield line
+                profiler.resume()
+            profiler.exit()
+
+    def eval_expr(self, expr, local_vars=None):
+        self.profiler.call("eval")
+        try:
+            return super().eval_expr(expr, local_vars)
+        finally:
+            self.profiler.ret()
+
+    def substitute(self, parts, local_vars=None):
+        self.profiler.call("subst")
+        try:
+            return super().substitute(parts, local_vars)
+        finally:
+            self.profiler.ret()
+
+
+OUTPUT_BUFFER_SIZE = 1 << 20
+
+def write_lines(file, lines): #same text as '\n'.join(lines) without building it in memory
+    lines = iter(lines)
+    for line in lines:
+        file.write(line)
+        break
+    for line in lines:
+        file.write('\n')
+        file.write(line)
+
+UPDATED, UNCHANGED = "updated", "unchanged" #process_file results, False when it failed
+
+def _same_content(path, other_path): #same bytes, compared by hash when the sizes match
     try:
-        with open(input_path, 'r') as file:
-            content = file.read()
-        generator = CodeGenerator(global_vars=global_vars,debug=debug)
-        generated_code = generator.generate(content) #generate the code 
+        if os.path.getsize(path) != os.path.getsize(other_path):
+            return False
+    except OSError:
+        return False
+    return _file_hash(path) == _file_hash(other_path)
+
+def _depfile_path(path): #make escaping, ninja reads the same syntax
+    return path.replace('\\', '/').replace('$', '$$').replace('#', '\\#').replace(' ', '\\ ')
+
+def write_depfile(depfile_path, output_path, input_path, dependencies): #output: template and every file opened
+    prerequisites = [input_path] + sorted(dependencies)
+    text = _depfile_path(output_path) + ":" + "".join(f" \\\n  {_depfile_path(path)}" for path in prerequisites) + "\n"
+    try:
+        with open(depfile_path, 'r') as file:
+            if file.read() == text: #unchanged, keep its mtime like the output
+                return
+    except OSError:
+        pass
+    tmp_path = depfile_path + ".tmp"
+    with open(tmp_path, 'w') as file:
+        file.write(text)
+    os.replace(tmp_path, depfile_path)
+
+def print_output_counts(statuses):
+    statuses = list(statuses)
+    print(f"Outputs: {statuses.count(UPDATED)} updated, {statuses.count(UNCHANGED)} unchanged")
+
+SESSION_TEMPLATES = 256 #parsed template strings kept by a Session
+
+class Template: #parsed template of a Session, rendered any number of times
+    __slots__ = ("content", "nodes", "compiled")
+
+    def __init__(self, content, nodes):
+        self.content = content
+        self.nodes = nodes #TemplateParser tree
+        self.compiled = False #CompiledTemplate, None if it can't compile, False until the compile engine asks
+
+class Session: #in-process expansion for test harnesses, caches shared by every call and errors raised as ExpandError
+    def __init__(self, global_vars=None, include_dirs=(), macro_index=None, engine="interpret",
+                 max_iterations=None, quiet=True):
+        if engine not in ("interpret", "compile", "check"):
+            raise ValueError(f"unknown engine: {engine}")
+        self.global_vars = dict(global_vars or {}) #every render sees them, its own variables take precedence
+        self.macro_store = MacroStore(MacroIndex.open(macro_index), include_dirs) #headers parsed once per session
+        self.engine = engine
+        self.max_iterations = max_iterations
+        self.quiet = quiet #drop the console lines of $include and the warnings of its headers
+        self.dependencies = set() #files opened by the includes of every render
+        self.templates = collections.OrderedDict() #content -> Template, least recently used first
+
+    def parse(self, content): #Template of a template text, parsed once while it is among the recent ones
+        template = self.templates.get(content)
+        if template is None:
+            template = self.templates[content] = Template(content, TemplateParser().parse(content))
+            if len(self.templates) > SESSION_TEMPLATES:
+                self.templates.popitem(last=False)
+        else:
+            self.templates.move_to_end(content)
+        return template
+
+    def load(self, path): #Template of a .svp file
+        with open(path, 'r') as file:
+            return self.parse(file.read())
+
+    def lines(self, template, variables=None): #iterator of the output lines of a template text or Template
+        if not isinstance(template, Template):
+            template = self.parse(template)
+        generator_options = dict(parent_vars=variables, global_vars=self.global_vars, dependencies=self.dependencies,
+                                 macro_store=self.macro_store, max_iterations=self.max_iterations, echo=not self.quiet)
+        lines = CodeGenerator(**generator_options).stream(template.nodes)
+        if self.engine != "interpret":
+            compiled = self.compiled(template)
+            if compiled is None:
+                pass
+            elif self.engine == "compile":
+                lines = compiled.stream(CodeGenerator(**generator_options))
+            else:
+                lines = check_engines(lines, compiled.stream(CodeGenerator(**dict(generator_options, echo=False))),
+                                      "<template>", not self.quiet)
+        return lines
+
+    def render(self, template, variables=None): #output text of a template text or Template
+        return '\n'.join(self.lines(template, variables))
+
+    @staticmethod
+    def compiled(template):
+        if template.compiled is False:
+            try:
+                source = TemplateCompiler().compile(template.nodes)
+                template.compiled = CompiledTemplate(compile(source, "<svp session>", "exec"))
+            except (SyntaxError, RecursionError, MemoryError): #too deep for python, the interpreter renders it
+                template.compiled = None
+        return template.compiled
+
+
+class TemplateStore: #one per run, template text, parsed tree and compiled form keyed by path and mtime
+    def __init__(self):
+        self.templates = {} #abs path -> [mtime, content, nodes or None, compiled or False if not loaded yet]
+
+    def load(self, input_path): #nodes of the template, parsed on the first call while it is unchanged
+        entry = self._entry(input_path)
+        if entry[2] is None:
+            entry[2] = TemplateParser().parse(entry[1])
+        return entry[2]
+
+    def compiled(self, input_path): #load_compiled of the template, once per run, a cache hit needs no parse
+        entry = self._entry(input_path)
+        if entry[3] is False:
+            entry[3] = load_compiled(input_path, entry[1], entry[2])
+        return entry[3]
+
+    def _entry(self, input_path):
+        abs_path = os.path.abspath(input_path)
+        mtime = os.stat(abs_path).st_mtime_ns
+        entry = self.templates.get(abs_path)
+        if entry is None or entry[0] != mtime:
+            with open(input_path, 'r') as file:
+                content = file.read()
+            entry = self.templates[abs_path] = [mtime, content, None, False]
+        return entry
+
+def process_file(input_path, output_path, global_vars=None, debug=False, dependencies=None,
+                 macro_store=None, profile=False, max_iterations=None, engine="interpret", macro_index=None,
+                 include_dirs=(), depfile=False, templates=None, unresolved=None):#progress the file
+    debug_file = None
+    if dependencies is None:
+        dependencies = set()
+    if unresolved is None:
+        unresolved = {}
+    if templates is None:
+        templates = TemplateStore()
+    try:
+        if macro_store is None: #one file: the on-disk index is the only cache shared with other runs
+            macro_store = MacroStore(MacroIndex.open(macro_index), include_dirs)
+        if debug: #stream the trace into the debug file
+            debug_path = os.path.splitext(output_path)[0] + ".debug"
+            debug_dir = os.path.dirname(debug_path)
+            if debug_dir:
+                os.makedirs(debug_dir, exist_ok=True)
+            debug_file = open(debug_path, 'w')
+        generator_options = dict(global_vars=global_vars, tracer=Tracer(debug_file) if debug else None,
+                                 dependencies=dependencies, #dependencies collect the included files
+                                 unresolved=unresolved, #and the include names that were not found
+                                 macro_store=macro_store, max_iterations=max_iterations)
+        if profile:
+            profiler = Profiler()
+            generator = ProfilingCodeGenerator(profiler=profiler, **generator_options)
+        else:
+            generator = CodeGenerator(**generator_options)
+        lines = None #the template is parsed for the interpreter, or to compile it when it is not cached
+        if engine != "interpret":
+            if debug or profile:
+                print("Note: -b/--profile run the interpreter engine")
+            else:
+                nodes = templates.load(input_path) if engine == "check" else None #one parse for both engines
+                compiled = templates.compiled(input_path)
+                if compiled is None:
+                    pass
+                elif engine == "compile":
+                    lines = compiled.stream(generator)
+                else: #check: write the interpreter output, fail on the first line the compiled one differs
+                    lines = check_engines(generator.stream(nodes),
+                                          compiled.stream(CodeGenerator(**dict(generator_options, echo=False))),
+                                          input_path)
+        if lines is None:
+            lines = generator.stream(templates.load(input_path))
         output_dir = os.path.dirname(output_path)
         if output_dir:
             os.makedirs(output_dir, exist_ok=True)
-        with open(output_path, 'w') as file:
-            file.write(generated_code)
-        print(f"Generated: {output_path}")
-        if debug:
-            debug_path = os.path.splitext(output_path)[0] + ".debug"
-            with open(debug_path, 'w') as debug_file:
-                debug_file.write("\n".join(generator.debug_log))
+        tmp_path = output_path + ".tmp"
+        try:
+            with open(tmp_path, 'w', buffering=OUTPUT_BUFFER_SIZE) as file:
+                write_lines(file, lines) #generate the code straight into the file
+            if _same_content(tmp_path, output_path): #keep the old file and its mtime
+                status = UNCHANGED
+            else:
+                os.replace(tmp_path, output_path) #readers see the old or the new file, never half of one
+                status = UPDATED
+        finally:
+            if os.path.exists(tmp_path): #failed half way or unchanged, keep the old output
+                os.remove(tmp_path)
+        print(f"Generated: {output_path}" if status == UPDATED else f"Unchanged: {output_path}")
+        if profile: #sorted table and flamegraph collapsed stacks
+            profile_base = os.path.splitext(output_path)[0]
+            with open(profile_base + ".profile", 'w') as file:
+                file.write(profiler.report() + "\n")
+            with open(profile_base + ".collapsed", 'w') as file:
+                file.write(profiler.collapsed_stacks() + "\n")
+            print(f"Profile: {profile_base}.profile {profile_base}.collapsed")
+        if depfile:
+            write_depfile(os.path.splitext(output_path)[0] + ".d", output_path, input_path, dependencies)
+        if debug_file:
+            debug_file.close()
             print(f"Debug log: {debug_path}")
     except Exception as e:
+        import traceback
         error_msg = f"Error processing {input_path}: {str(e)}\n{traceback.format_exc()}"
         print(error_msg, file=sys.stderr)
-        if debug:
-            debug_path = os.path.splitext(output_path)[0] + ".debug"
-            with open(debug_path, 'w') as debug_file:
-                debug_file.write("\n".join(generator.debug_log if 'generator' in locals() else []))
-                debug_file.write(f"\n\nERROR: {error_msg}")
+        if debug_file:
+            debug_file.write(f"\n\nERROR: {error_msg}")
+            debug_file.close()
             print(f"Debug log with error: {debug_path}")
-        sys.exit(1)
+        return False
+    return status
+
+BUILD_CACHE_FILE = ".expand_gen_cache.json"
+
+_worker_macro_store = None #macro store of a worker process, kept across its jobs
+_worker_templates = None #parsed templates of a worker process, kept across its jobs
+
+def _process_file_job(job): #worker: process one file, console output kept for the parent
+    global _worker_macro_store, _worker_templates
+    input_path, output_path, global_vars, options = job
+    if _worker_macro_store is None:
+        _worker_macro_store = MacroStore(MacroIndex.open(options.get("macro_index")), options.get("include_dirs", ()))
+        _worker_templates = TemplateStore()
+    console = io.StringIO()
+    dependencies = set()
+    unresolved = {}
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(console), contextlib.redirect_stderr(console):
+        ok = process_file(input_path, output_path, global_vars, dependencies=dependencies, unresolved=unresolved,
+                          macro_store=_worker_macro_store, templates=_worker_templates, **options)
+    return ok, time.perf_counter() - start, console.getvalue(), dependencies, unresolved
+
+
+def _file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class BuildCache: #manifest of the inputs each output was generated from
+    VERSION = 1
+
+    def __init__(self, path, force=False):
+        import json
+        self.path = path
+        self.force = force
+        self.entries = {}
+        self.generator_hash = _engine_hash() #a new generator rebuilds everything
+        self.hashes = {} #file hash memo for this run
+        try:
+            with open(path, 'r') as file:
+                manifest = json.load(file)
+            if manifest.get("version") == self.VERSION:
+                self.entries = manifest.get("outputs", {})
+        except (OSError, ValueError):
+            pass
+
+    def _hash(self, path):
+        if path not in self.hashes:
+            try:
+                self.hashes[path] = _file_hash(path)
+            except OSError:
+                self.hashes[path] = None
+        return self.hashes[path]
+
+    @staticmethod
+    def vars_hash(global_vars):
+        text = repr(sorted((global_vars or {}).items(), key=lambda item: item[0]))
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    @staticmethod
+    def include_dirs_hash(include_dirs): #the search order matters, the first dir holding a name wins
+        text = repr([os.path.normpath(os.path.abspath(path)) for path in include_dirs or ()])
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def rebuild_reason(self, input_path, output_path, global_vars, debug=False, include_dirs=()): #None if up to date
+        if self.force:
+            return "forced"
+        if debug:
+            return "debug log or profile requested"
+        entry = self.entries.get(os.path.abspath(output_path))
+        if entry is None:
+            return "not in cache"
+        if not os.path.isfile(output_path):
+            return "output missing"
+        if entry.get("generator") != self.generator_hash:
+            return "generator changed"
+        if entry.get("template") != self._hash(os.path.abspath(input_path)):
+            return "template changed"
+        if entry.get("vars") != self.vars_hash(global_vars):
+            return "global variables changed"
+        if entry.get("include_dirs") != self.include_dirs_hash(include_dirs):
+            return "include dirs changed"
+        for path, digest in entry.get("includes", {}).items():
+            if self._hash(path) != digest:
+                return f"include changed: {path}"
+        for name, dirs in entry.get("unresolved", {}).items(): #not found, or found after these dirs
+            found = _include_resolves(name, dirs)
+            if found:
+                return f"include {name} now found as {found}"
+        return None
+
+    def record(self, input_path, output_path, global_vars, dependencies, unresolved=None, include_dirs=()):
+        self.entries[os.path.abspath(output_path)] = {
+            "template": self._hash(os.path.abspath(input_path)),
+            "vars": self.vars_hash(global_vars),
+            "include_dirs": self.include_dirs_hash(include_dirs),
+            "generator": self.generator_hash,
+            "includes": {path: self._hash(path) for path in sorted(dependencies)},
+            "unresolved": {name: list(dirs) for name, dirs in sorted((unresolved or {}).items())},
+        }
+
+    def forget(self, output_path):
+        self.entries.pop(os.path.abspath(output_path), None)
+
+    def save(self):
+        import json
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w') as file:
+            json.dump({"version": self.VERSION, "outputs": self.entries}, file, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
 
-def process_directory(directory, global_vars=None, debug=False): #progress the directory
-    for root, _, files in os.walk(directory):
-        for file in files:
+def find_templates(directory): #(input, output) of every .svp below the directory, in a stable order
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for file in sorted(files):
             if file.endswith(".svp"):
-                input_path = os.path.join(root, file)
-                output_path = os.path.join(root, file.replace(".svp", ".sv"))
-                process_file(input_path, output_path, global_vars,debug)
+                yield os.path.join(root, file), os.path.join(root, file.replace(".svp", ".sv"))
 
+def run_file_jobs(file_jobs, jobs=1, macro_index=None, include_dirs=()): #[(job, ok, seconds, dependencies, unresolved)] in job order
+    if jobs is not None and jobs <= 0:
+        jobs = os.cpu_count() or 1
+    results = []
+    if jobs and jobs > 1 and len(file_jobs) > 1: #spread files on worker processes
+        import concurrent.futures
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = [executor.submit(_process_file_job, job) for job in file_jobs]
+            for job, future in zip(file_jobs, futures): #print in file order
+                try:
+                    ok, elapsed, console, dependencies, unresolved = future.result()
+                except Exception as e: #worker died
+                    ok, elapsed, console = False, 0.0, f"Error processing {job[0]}: worker failed: {e}\n"
+                    dependencies, unresolved = (), {}
+                sys.stdout.write(console)
+                results.append((job, ok, elapsed, dependencies, unresolved))
+    else:
+        macro_store = MacroStore(MacroIndex.open(macro_index), include_dirs) #headers shared by the templates are parsed once
+        templates = TemplateStore() #and each template once for every output made from it
+        for job in file_jobs:
+            input_path, output_path, global_vars, options = job
+            dependencies = set()
+            unresolved = {}
+            start = time.perf_counter()
+            ok = process_file(input_path, output_path, global_vars, dependencies=dependencies, unresolved=unresolved,
+                              macro_store=macro_store, templates=templates, **options)
+            results.append((job, ok, time.perf_counter() - start, dependencies, unresolved))
+    return results
+
+def print_summary(results, skipped=None, by_output=False): #failed inputs, or outputs when one input makes several
+    label = 1 if by_output else 0
+    failures = [job[label] for job, ok, *_ in results if not ok]
+    print(f"Summary: {len(results)} files, {len(results) - len(failures)} ok, {len(failures)} failed"
+          + (f", {skipped} up to date" if skipped is not None else ""))
+    for path in failures:
+        print(f"  FAILED: {path}")
+    print_output_counts(ok for _, ok, *_ in results)
+    if results:
+        print("Timing:")
+        for job, ok, elapsed, *_ in sorted(results, key=lambda result: result[2], reverse=True):
+            print(f"  {elapsed:9.3f}s  {'ok    ' if ok else 'FAILED'}  {job[label]}")
+    return failures
+
+def process_directory(directory, global_vars=None, debug=False, jobs=1, cache=None, profile=False,
+                      max_iterations=None, engine="interpret", macro_index=None, include_dirs=(),
+                      depfile=False): #progress the directory
+    options = dict(debug=debug, profile=profile, max_iterations=max_iterations, engine=engine,
+                   macro_index=macro_index, include_dirs=tuple(include_dirs), depfile=depfile) #process_file options
+    file_jobs = []
+    skipped = 0
+    for input_path, output_path in find_templates(directory):
+        if cache is not None:
+            reason = cache.rebuild_reason(input_path, output_path, global_vars, debug or profile, include_dirs)
+            if reason is None and depfile and not os.path.isfile(os.path.splitext(output_path)[0] + ".d"):
+                reason = "depfile missing"
+            if reason is None:
+                skipped += 1
+                print(f"Up to date: {output_path}")
+                continue
+            print(f"Rebuild {output_path}: {reason}")
+        file_jobs.append((input_path, output_path, global_vars, options))
+    results = run_file_jobs(file_jobs, jobs, macro_index, include_dirs)
+    if cache is not None:
+        for (input_path, output_path, *_), ok, _, dependencies, unresolved in results:
+            if ok:
+                cache.record(input_path, output_path, global_vars, dependencies, unresolved, include_dirs)
+            else:
+                cache.forget(output_path)
+        cache.save()
+    return print_summary(results, skipped if cache is not None else None)
+
+SWEEP_NAME = "name" #configuration field naming its output directory
+
+def load_sweep(path): #[(name, vars)] of a JSON list or {name: vars} object, or a CSV with one configuration per row
+    import csv
+    import json
+    try:
+        with open(path, 'r', newline='') as file:
+            if path.lower().endswith(".csv"): #values are read like -v, empty cells keep the -v value
+                rows = [{key.strip(): value.strip() for key, value in row.items() if key and value and value.strip()}
+                        for row in csv.DictReader(file)]
+                rows = [{key: value if key == SWEEP_NAME else parse_value(value) for key, value in row.items()}
+                        for row in rows]
+            else:
+                rows = json.load(file)
+    except (OSError, ValueError, csv.Error) as e:
+        sys.exit(f"Error reading sweep file {path}: {e}")
+    if isinstance(rows, dict):
+        rows = [dict(config, **{SWEEP_NAME: name}) if isinstance(config, dict) else config for name, config in rows.items()]
+    if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+        sys.exit(f"Error in sweep file {path}: expected a list of variable objects or {{name: variables}}")
+    configs = []
+    names = set()
+    width = len(str(max(len(rows) - 1, 0)))
+    for index, row in enumerate(rows):
+        variables = dict(row)
+        name = str(variables.pop(SWEEP_NAME, f"cfg{index:0{width}d}")).strip()
+        if not name or name in (".", "..") or "/" in name or "\\" in name:
+            sys.exit(f"Error in sweep file {path}: invalid configuration name '{name}'")
+        if name in names:
+            sys.exit(f"Error in sweep file {path}: duplicate configuration name '{name}'")
+        names.add(name)
+        configs.append((name, variables))
+    return configs
+
+def process_sweep(templates, configs, sweep_dir, global_vars=None, debug=False, jobs=1, profile=False,
+                  max_iterations=None, engine="interpret", macro_index=None, include_dirs=(),
+                  depfile=False): #every template rendered once per configuration into sweep_dir/<name>/
+    options = dict(debug=debug, profile=profile, max_iterations=max_iterations, engine=engine,
+                   macro_index=macro_index, include_dirs=tuple(include_dirs), depfile=depfile) #process_file options
+    file_jobs = []
+    for name, config_vars in configs:
+        variables = dict(global_vars or {}) #the configuration overrides -v
+        variables.update(config_vars)
+        for input_path, relative_output in templates:
+            file_jobs.append((input_path, os.path.join(sweep_dir, name, relative_output), variables, options))
+    print(f"Sweep: {len(configs)} configurations x {len(templates)} templates -> {sweep_dir}")
+    results = run_file_jobs(file_jobs, jobs, macro_index, include_dirs) #templates and headers parsed once per process
+    return print_summary(results, by_output=True)
+
+WATCH_INTERVAL = 0.5 #seconds between two polls of the watched files
+REQUEST_MAX_SIZE = 1 << 20
+
+class Watcher: #long running -f/-d build, templates and headers stay parsed, a changed file rebuilds what read it
+    def __init__(self, directory=None, files=(), output=None, global_vars=None, options=None):
+        self.directory = directory
+        self.files = list(files)
+        self.output = output
+        self.global_vars = global_vars
+        self.options = dict(options or {}) #process_file options
+        self.macro_store = MacroStore(MacroIndex.open(self.options.get("macro_index")),
+                                      self.options.get("include_dirs", ()))
+        self.templates = TemplateStore()
+        self.outputs = {} #template -> output
+        self.dependencies = {} #template -> abs paths it included at its last build, the include graph
+        self.unresolved = {} #template -> {include name: search dirs that did not hold it} at its last build
+        self.stamps = {} #template -> {path: mtime} of the template and its includes at its last build
+        self.builds = 0
+        self.stopped = False
+
+    def scan(self): #template -> output of the -f files and the -d tree, templates added since are picked up
+        outputs = {}
+        for input_path in self.files:
+            if os.path.isfile(input_path):
+                outputs[input_path] = self.output or os.path.splitext(input_path)[0] + ".sv"
+        if self.directory:
+            outputs.update(find_templates(self.directory))
+        return outputs
+
+    @staticmethod
+    def stamp(path): #mtime, None once the file is gone
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+
+    def poll(self): #(templates to rebuild, changed files), each file is stat once
+        self.outputs = self.scan()
+        for input_path in set(self.stamps) - set(self.outputs): #template removed
+            self.stamps.pop(input_path)
+            self.dependencies.pop(input_path, None)
+            self.unresolved.pop(input_path, None)
+        seen = {}
+        found = {} #(include name, dirs) -> path it now resolves to in those dirs
+        stale = []
+        changed = set()
+        for input_path in self.outputs:
+            stamps = self.stamps.get(input_path)
+            if stamps is None: #new template
+                stale.append(input_path)
+                continue
+            for path, mtime in stamps.items():
+                if path not in seen:
+                    seen[path] = self.stamp(path)
+                if seen[path] != mtime:
+                    changed.add(path)
+                    if input_path not in stale:
+                        stale.append(input_path)
+            for name, dirs in self.unresolved.get(input_path, {}).items(): #created since, or shadowing the one used
+                if (name, dirs) not in found:
+                    found[name, dirs] = _include_resolves(name, dirs)
+                if found[name, dirs]:
+                    changed.add(found[name, dirs])
+                    if input_path not in stale:
+                        stale.append(input_path)
+        return stale, changed
+
+    def build(self, inputs, changed=()): #[(template, output, status, console)], status False when it failed
+        self.macro_store.refresh(changed) #include names are looked up again, new files are seen
+        results = []
+        for input_path in inputs:
+            output_path = self.outputs[input_path]
+            stamps = {path: self.stamp(path) for path in (input_path, *self.dependencies.get(input_path, ()))}
+            dependencies = set()
+            unresolved = {}
+            console = io.StringIO()
+            with contextlib.redirect_stdout(console), contextlib.redirect_stderr(console):
+                status = process_file(input_path, output_path, self.global_vars, dependencies=dependencies,
+                                      unresolved=unresolved, macro_store=self.macro_store, templates=self.templates,
+                                      **self.options)
+            for path in dependencies - set(stamps): #included for the first time
+                stamps[path] = self.stamp(path)
+            self.stamps[input_path] = stamps
+            self.dependencies[input_path] = dependencies
+            self.unresolved[input_path] = unresolved
+            sys.stdout.write(console.getvalue())
+            results.append((input_path, output_path, status, console.getvalue()))
+        self.builds += 1
+        return results
+
+    def select(self, paths): #(templates, unknown paths) of a request naming templates, outputs or included files
+        templates = []
+        unknown = []
+        for path in paths:
+            abs_path = os.path.abspath(path)
+            found = [input_path for input_path, output_path in self.outputs.items()
+                     if abs_path in (os.path.abspath(input_path), os.path.abspath(output_path))
+                     or abs_path in self.dependencies.get(input_path, ())]
+            if not found:
+                unknown.append(path)
+            templates += [input_path for input_path in found if input_path not in templates]
+        return templates, unknown
+
+    def request(self, message): #reply of one socket request
+        cmd = message.get("cmd") if isinstance(message, dict) else None
+        if cmd == "regenerate": #{"cmd": "regenerate", "paths": [...]}, no paths: every template
+            start = time.perf_counter()
+            stale, changed = self.poll()
+            paths = message.get("paths")
+            templates, unknown = self.select(paths) if paths else (list(self.outputs), [])
+            results = self.build(templates, changed)
+            return {"ok": not unknown and all(status for _, _, status, _ in results), "unknown": unknown,
+                    "results": [{"template": input_path, "output": output_path, "status": status or "failed",
+                                 "console": console} for input_path, output_path, status, console in results],
+                    "ms": round((time.perf_counter() - start) * 1000, 3)}
+        if cmd == "status":
+            return {"ok": True, "templates": len(self.outputs), "builds": self.builds,
+                    "macro_store_hits": self.macro_store.hits, "macro_store_misses": self.macro_store.misses}
+        if cmd == "stop":
+            self.stopped = True
+            return {"ok": True}
+        return {"ok": False, "error": f"unknown request: {message!r}"}
+
+    def serve(self, server): #answer one connection: a JSON line in, a JSON line out
+        import json
+        conn, _ = server.accept()
+        with conn:
+            conn.settimeout(5)
+            data = b""
+            try:
+                while b"\n" not in data and len(data) < REQUEST_MAX_SIZE:
+                    chunk = conn.recv(65536)
+                    if not chunk:
+                        break
+                    data += chunk
+                try:
+                    reply = self.request(json.loads(data.decode()))
+                except ValueError as e:
+                    reply = {"ok": False, "error": f"bad request: {e}"}
+                conn.sendall(json.dumps(reply).encode() + b"\n")
+            except OSError as e: #client gone
+                print(f"Warning: request failed: {e}")
+
+    @staticmethod
+    def listen(socket_path):
+        import socket
+        if not hasattr(socket, "AF_UNIX"):
+            sys.exit("Error: --socket needs unix domain sockets")
+        if os.path.exists(socket_path):
+            try:
+                send_request(socket_path, {"cmd": "status"})
+            except (OSError, ValueError): #left over by a daemon that died
+                os.remove(socket_path)
+            else:
+                sys.exit(f"Error: a watcher already serves {socket_path}")
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(socket_path)
+        server.listen(8)
+        return server
+
+    def report(self, results, changed=()):
+        statuses = [status for _, _, status, _ in results]
+        failed = statuses.count(False)
+        print(f"Watch: {len(results)} rebuilt ({statuses.count(UPDATED)} updated, {statuses.count(UNCHANGED)} unchanged, "
+              f"{failed} failed)" + (f" after changes to {', '.join(sorted(changed))}" if changed else ""))
+
+    def run(self, socket_path=None, interval=WATCH_INTERVAL):
+        import select
+        self.outputs = self.scan()
+        self.report(self.build(list(self.outputs)))
+        server = self.listen(socket_path) if socket_path else None
+        print(f"Watching {len(self.outputs)} templates" + (f", requests on {socket_path}" if server else "")
+              + " (Ctrl-C to stop)")
+        next_poll = time.monotonic() + interval
+        try:
+            while not self.stopped:
+                timeout = max(next_poll - time.monotonic(), 0)
+                if server is not None:
+                    if select.select([server], [], [], timeout)[0]:
+                        self.serve(server)
+                        continue
+                else:
+                    time.sleep(timeout)
+                stale, changed = self.poll()
+                if stale:
+                    self.report(self.build(stale, changed), changed)
+                next_poll = time.monotonic() + interval
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if server is not None:
+                server.close()
+                with contextlib.suppress(OSError):
+                    os.remove(socket_path)
+
+def send_request(socket_path, message): #reply of a watcher to one request
+    import json
+    import socket
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_path)
+        client.sendall(json.dumps(message).encode() + b"\n")
+        data = b""
+        while not data.endswith(b"\n"):
+            chunk = client.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+    return json.loads(data.decode())
+
+
+def parse_value(value_str): #-v value text -> python value, the text itself when it is not a literal
+    try:
+        if value_str.startswith('[') and value_str.endswith(']'): #support list 
+            return ast.literal_eval(value_str)
+        return eval(value_str, {'__builtins__': __builtins__}, {})
+    except (ValueError, SyntaxError, NameError): #a bare word like -v mode=fast stays text
+        return value_str
 
 def parse_vars(var_args): #get variable
     variables = {}
@@ -523,44 +2453,138 @@ def parse_vars(var_args): #get variable
             print(f"Warning: Invalid variable format '{var_arg}', skipping.")
             continue
         var_name, value_str = var_arg.split('=', 1)
-        var_name = var_name.strip()
-        value_str = value_str.strip()
-        try:
-            if value_str.startswith('[') and value_str.endswith(']'): #support list 
-                value = ast.literal_eval(value_str)
-            else:
-                value = eval(value_str, {'__builtins__': __builtins__}, {})
-        except (ValueError, SyntaxError):
-            value = value_str
-        variables[var_name] = value
+        variables[var_name.strip()] = parse_value(value_str.strip())
     return variables
 
+def parse_incdirs(incdir_args): #-I dir or -I +incdir+dir1+dir2, in search order
+    include_dirs = []
+    for incdir_arg in incdir_args:
+        if incdir_arg.startswith("+incdir+"):
+            include_dirs.extend(path for path in incdir_arg[len("+incdir+"):].split('+') if path)
+        else:
+            include_dirs.append(incdir_arg)
+    for path in include_dirs:
+        if not os.path.isdir(path):
+            print(f"Warning: include directory not found: {path}")
+    return include_dirs
+
 def main():
+    import argparse
     parser = argparse.ArgumentParser(description='SystemVerilog code generator.')
     parser.add_argument('-d', '--directory', help='Process all .svp files in directory')
     parser.add_argument('-f', '--file', nargs='+', help='Process specific .svp files')
     parser.add_argument('-o', '--output', help='Output file (for single file processing)')
     parser.add_argument('-v', '--var', action='append', default=[], 
                         help='Set global variables (e.g. -v width=16 -v depth=32)')
+    parser.add_argument('-I', '--incdir', action='append', default=[],
+                        help='Search `include and $include files here, in order after the working directory '
+                             '(-I dir or -I +incdir+dir1+dir2)')
     parser.add_argument('-b', '--debug', action='store_true', 
                         help='Generate debug log files for troubleshooting')
+    parser.add_argument('--profile', action='store_true',
+                        help='Write a per-line .profile table and a flamegraph .collapsed file next to each output')
+    parser.add_argument('--max-iterations', type=int, default=MAX_LOOP_ITERATIONS,
+                        help='Fail a for loop running more iterations than this')
+    parser.add_argument('--depfile', action='store_true',
+                        help='Write a Make/Ninja .d file next to each output listing the template and every included file')
+    parser.add_argument('--engine', choices=('interpret', 'compile', 'check'), default='interpret',
+                        help='compile: run templates as python generators cached in __pycache__, '
+                             'check: run both engines and fail if their outputs differ')
+    parser.add_argument('--macro-index', default=default_macro_index(),
+                        help='sqlite file keeping parsed `include headers for later runs (default: %(default)s)')
+    parser.add_argument('--no-macro-index', action='store_true', help='Parse every `include header from its text')
+    parser.add_argument('--sweep', metavar='FILE',
+                        help='Render the -f/-d templates once per variable set of a JSON or CSV file, '
+                             'each into its own directory under --sweep-dir')
+    parser.add_argument('--sweep-dir', default='sweep', help='Output root of --sweep (default: %(default)s)')
+    parser.add_argument('--watch', action='store_true',
+                        help='Keep running, rebuild the -f/-d outputs whose template or included files change')
+    parser.add_argument('--poll-interval', type=float, default=WATCH_INTERVAL,
+                        help='Seconds between two checks of the watched files (default: %(default)s)')
+    parser.add_argument('--socket', metavar='PATH',
+                        help='With --watch: answer JSON line requests on this unix socket, '
+                             'with --regenerate: send the request to the watcher listening there')
+    parser.add_argument('--regenerate', nargs='*', metavar='FILE',
+                        help='Ask the --socket watcher to rebuild these templates, outputs or included files '
+                             '(none: everything) and print its reply')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Worker processes for -d and --sweep (0 = one per CPU)')
+    parser.add_argument('--force', action='store_true',
+                        help='Regenerate every file of -d even if the build cache says it is up to date')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Do not read or write the -d build cache')
     args = parser.parse_args()
     global_vars = parse_vars(args.var)
+    macro_index = None if args.no_macro_index else args.macro_index
+    include_dirs = parse_incdirs(args.incdir)
     
     if global_vars: # print variables
         print("Global variables:")
         for var, value in global_vars.items():
             print(f"  ${var} = {value}")
+    if args.regenerate is not None: #client of a running --watch
+        if not args.socket:
+            parser.error("--regenerate needs --socket")
+        try:
+            reply = send_request(args.socket, {"cmd": "regenerate", "paths": args.regenerate})
+        except (OSError, ValueError) as e:
+            sys.exit(f"Error: no watcher on {args.socket}: {e}")
+        for result in reply.get("results", []):
+            sys.stdout.write(result["console"])
+        for path in reply.get("unknown", []):
+            print(f"Warning: not a watched template, output or include: {path}")
+        print(f"Regenerated {len(reply.get('results', []))} in {reply.get('ms', 0)} ms")
+        if not reply.get("ok"):
+            sys.exit(1)
+        return
     if not args.directory and not args.file:
         parser.error("At least one of -d or -f must be specified")
+    if args.watch: #first build everything, then only what changes
+        if args.sweep:
+            parser.error("--watch can't be used with --sweep")
+        if args.file and len(args.file) > 1 and args.output:
+            sys.exit("Error: -o can only be used with single file input")
+        if args.directory and not os.path.isdir(args.directory):
+            sys.exit(f"Error: Directory not found: {args.directory}")
+        options = dict(debug=args.debug, profile=args.profile, max_iterations=args.max_iterations,
+                       engine=args.engine, macro_index=macro_index, include_dirs=tuple(include_dirs),
+                       depfile=args.depfile)
+        Watcher(args.directory, args.file or (), args.output, global_vars, options).run(args.socket,
+                                                                                        args.poll_interval)
+        return
+    if args.sweep: #-f files and -d templates for every configuration, nothing else is generated
+        if args.output:
+            parser.error("-o can't be used with --sweep, outputs go to --sweep-dir")
+        configs = load_sweep(args.sweep)
+        templates = []
+        if args.directory:
+            if not os.path.isdir(args.directory):
+                sys.exit(f"Error: Directory not found: {args.directory}")
+            templates += [(input_path, os.path.relpath(output_path, args.directory))
+                          for input_path, output_path in find_templates(args.directory)]
+        for input_path in args.file or ():
+            if not os.path.isfile(input_path):
+                print(f"Warning: File not found: {input_path}, skipping")
+                continue
+            templates.append((input_path, os.path.splitext(os.path.basename(input_path))[0] + ".sv"))
+        if process_sweep(templates, configs, args.sweep_dir, global_vars, args.debug, args.jobs, args.profile,
+                         args.max_iterations, args.engine, macro_index, include_dirs, args.depfile):
+            sys.exit(1)
+        return
     if args.directory: #expand the directory
         if not os.path.isdir(args.directory):
             sys.exit(f"Error: Directory not found: {args.directory}")
         print(f"Processing directory: {args.directory} {'with debug' if args.debug else ''}")
-        process_directory(args.directory, global_vars, args.debug)
+        cache = None
+        if not args.no_cache: #skip outputs whose template, includes and -v are unchanged
+            cache = BuildCache(os.path.join(args.directory, BUILD_CACHE_FILE), force=args.force)
+        if process_directory(args.directory, global_vars, args.debug, args.jobs, cache, args.profile,
+                             args.max_iterations, args.engine, macro_index, include_dirs, args.depfile):
+            sys.exit(1)
     if args.file: #expand the file
         if len(args.file) > 1 and args.output:
             sys.exit("Error: -o can only be used with single file input")
+        statuses = []
         for input_path in args.file:
             if not os.path.isfile(input_path):
                 print(f"Warning: File not found: {input_path}, skipping")
@@ -571,7 +2595,13 @@ def main():
                 base, ext = os.path.splitext(input_path) #default svp to sv
                 output_path = base + ".sv"
             print(f"Processing file: {input_path} -> {output_path} {'with debug' if args.debug else ''}")
-            process_file(input_path, output_path, global_vars, args.debug)
+            status = process_file(input_path, output_path, global_vars, args.debug, profile=args.profile,
+                                  max_iterations=args.max_iterations, engine=args.engine, macro_index=macro_index,
+                                  include_dirs=include_dirs, depfile=args.depfile)
+            if not status:
+                sys.exit(1)
+            statuses.append(status)
+        print_output_counts(statuses)
 
 
 if __name__ == "__main__":
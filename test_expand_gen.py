@@ -0,0 +1,143 @@
+import os
+import io
+import tempfile
+import unittest
+import unittest.mock
+import contextlib
+
+import expand_gen
+
+#USEAGE: python -m unittest test_expand_gen (or python -m pytest)
+
+
+def write(path, text):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, 'w') as file:
+        file.write(text)
+
+def read(path):
+    with open(path, 'r') as file:
+        return file.read()
+
+
+class MacroIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = self.tmp.name
+        self.index = os.path.join(self.root, "cache", "macro_index.sqlite")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def render(self, template, include_dirs): #output of one process_file run using the on-disk index
+        output = os.path.join(self.root, "t.sv")
+        with contextlib.redirect_stdout(io.StringIO()):
+            ok = expand_gen.process_file(template, output, macro_index=self.index, include_dirs=include_dirs)
+        self.assertTrue(ok)
+        return read(output)
+
+    def test_include_shadowed_by_an_earlier_dir(self): #inc1/h.svh created after inc2/h.svh was indexed
+        template = os.path.join(self.root, "t.svp")
+        write(template, '//:$include = "top.svh"\nw=${W}\n')
+        write(os.path.join(self.root, "inc2", "top.svh"), '`include "h.svh"\n')
+        write(os.path.join(self.root, "inc2", "h.svh"), '`define W 2\n')
+        include_dirs = (os.path.join(self.root, "inc1"), os.path.join(self.root, "inc2"))
+        self.assertEqual(self.render(template, include_dirs), "w=2\n")
+        write(os.path.join(self.root, "inc1", "h.svh"), '`define W 1\n')
+        self.assertEqual(self.render(template, include_dirs), "w=1\n")
+
+    def test_missing_include_created_later(self):
+        template = os.path.join(self.root, "t.svp")
+        write(template, '//:$include = "a.svh"\nb=${B}\n')
+        write(os.path.join(self.root, "inc", "a.svh"), '`define A 1\n`include "b.svh"\n')
+        include_dirs = (os.path.join(self.root, "inc"),)
+        self.assertEqual(self.render(template, include_dirs), "b=ERROR\n")
+        write(os.path.join(self.root, "inc", "b.svh"), '`define B 42\n')
+        self.assertEqual(self.render(template, include_dirs), "b=42\n")
+
+
+class BuildCacheTest(unittest.TestCase):
+    def test_include_shadowed_by_an_earlier_dir(self):
+        with tempfile.TemporaryDirectory() as root:
+            template = os.path.join(root, "rtl", "t.svp")
+            output = os.path.join(root, "rtl", "t.sv")
+            write(template, '//:$include = "top.svh"\nw=${W}\n')
+            write(os.path.join(root, "inc2", "top.svh"), '`include "h.svh"\n')
+            write(os.path.join(root, "inc2", "h.svh"), '`define W 2\n')
+            include_dirs = (os.path.join(root, "inc1"), os.path.join(root, "inc2"))
+            cache = expand_gen.BuildCache(os.path.join(root, "cache.json"))
+            dependencies, unresolved = set(), {}
+            with contextlib.redirect_stdout(io.StringIO()):
+                expand_gen.process_file(template, output, dependencies=dependencies, unresolved=unresolved,
+                                        include_dirs=include_dirs)
+            cache.record(template, output, None, dependencies, unresolved, include_dirs)
+            self.assertIsNone(cache.rebuild_reason(template, output, None, include_dirs=include_dirs))
+            write(os.path.join(root, "inc1", "h.svh"), '`define W 1\n')
+            reason = cache.rebuild_reason(template, output, None, include_dirs=include_dirs)
+            self.assertEqual(reason, f"include h.svh now found as {os.path.join(root, 'inc1', 'h.svh')}")
+
+
+class SubstituteTest(unittest.TestCase):
+    def test_index_errors(self): #a value that can't be indexed keeps the text, a bad index expression fails
+        for engine in ("interpret", "compile"):
+            session = expand_gen.Session({"t": [1, 2, 3]}, engine=engine)
+            self.assertEqual(session.render("${t[1]} ${t[9]} ${nope[1]}"), "2 ${t[9]} R")
+            with self.assertRaises(expand_gen.ExpressionError):
+                session.render("${t[$t.foo]}")
+
+
+class TemplateStoreTest(unittest.TestCase):
+    def test_cached_compile_run_skips_the_parse(self):
+        with tempfile.TemporaryDirectory() as root:
+            template = os.path.join(root, "t.svp")
+            output = os.path.join(root, "t.sv")
+            write(template, '//:for($i=0;$i<2;$i++) {\nw${i}\n//:}\n')
+            parse = expand_gen.TemplateParser.parse
+            with unittest.mock.patch.object(expand_gen.TemplateParser, "parse", autospec=True,
+                                            side_effect=parse) as mock, contextlib.redirect_stdout(io.StringIO()):
+                expand_gen.process_file(template, output, engine="compile", templates=expand_gen.TemplateStore())
+                self.assertEqual(mock.call_count, 1) #compiled and cached in __pycache__
+                expand_gen.process_file(template, output, engine="compile", templates=expand_gen.TemplateStore())
+                self.assertEqual(mock.call_count, 1)
+            self.assertEqual(read(output), "w0\nw1\n")
+
+
+class SessionTest(unittest.TestCase):
+    def test_quiet_session_leaves_stdout_alone(self): #header warnings go to the parser's sink, not a swapped stdout
+        with tempfile.TemporaryDirectory() as root:
+            header = os.path.join(root, "w.svh")
+            write(header, '`define A 1\n`include "missing.svh"\n')
+            template = f'//:$include = "{header}"\n//:$include = "{os.path.join(root, "nope.svh")}"\na=${{A}}'
+            console = io.StringIO()
+            with unittest.mock.patch.object(contextlib, "redirect_stdout") as redirect, \
+                    unittest.mock.patch("sys.stdout", console):
+                for engine in ("interpret", "check"):
+                    session = expand_gen.Session(engine=engine)
+                    self.assertEqual(session.render(template), "a=1")
+                    self.assertEqual(session.render(template), "a=1") #header from the cache
+            redirect.assert_not_called()
+            self.assertEqual(console.getvalue(), "")
+
+
+class WatcherTest(unittest.TestCase):
+    def test_header_created_after_startup(self):
+        with tempfile.TemporaryDirectory() as root:
+            template = os.path.join(root, "t.svp")
+            output = os.path.join(root, "t.sv")
+            write(template, '//:$include = "late.svh"\nw=${W}\n')
+            watcher = expand_gen.Watcher(files=[template], options={"include_dirs": (os.path.join(root, "inc"),)})
+            with contextlib.redirect_stdout(io.StringIO()):
+                watcher.outputs = watcher.scan()
+                watcher.build(list(watcher.outputs))
+                self.assertEqual(read(output), "w=ERROR\n")
+                write(os.path.join(root, "inc", "late.svh"), '`define W 42\n')
+                self.assertEqual(watcher.poll(), ([template], {os.path.join(root, "inc", "late.svh")}))
+                reply = watcher.request({"cmd": "regenerate", "paths": [template]})
+            self.assertEqual(reply["results"][0]["status"], expand_gen.UPDATED)
+            self.assertEqual(read(output), "w=42\n")
+
+
+if __name__ == "__main__":
+    unittest.main()